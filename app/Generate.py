@@ -1,194 +1,99 @@
-import requests
-from PIL import Image
 import streamlit as st
-from fire_state import create_store, form_update, get_state, set_state, get_store, set_store
-from io import BytesIO
-import datetime as dt
-import numpy as np
-import openai
-from openai import OpenAI
-import boto3
-from botocore.client import Config
-from dataplane import s3_upload
-
-def handle_openai_error(error):
-    if error.__class__.__name__ == "APIConnectionError":
-        message = "Issue connecting to OpenAI. Check your network settings, proxy configuration, SSL certificates, or firewall rules."
-    elif error.__class__.__name__ == "APITimeoutError":
-        message = "Request timed out. Retry your request after a brief wait."
-    elif error.__class__.__name__ == "AuthenticationError":
-        message = "API key or token was invalid, expired, or revoked. Contact sam.hudson@auctusdigital.co.uk or james.lilley@auctusdigital.co.uk for help."
-    elif error.__class__.__name__ == "BadRequestError":
-        message = "Your request was malformed or missing some required parameters, such as a token or an input. The error message should advise you on the specific error made. Check the documentation for the specific API method you are calling and make sure you are sending valid and complete parameters. You may also need to check the encoding, format, or size of your request data."
-    elif error.__class__.__name__ == "ConflictError":
-        message = "The resource was updated by another request. Try to update the resource again and ensure no other requests are trying to update it."
-    elif error.__class__.__name__ == "InternalServerError":
-        message = "Issue on OpenAI server side. Retry your request after a brief wait."
-    elif error.__class__.__name__ == "NotFoundError":
-        message = "Requested resource does not exist. Ensure you are the correct resource identifier."
-    elif error.__class__.__name__ == "PermissionDeniedError":
-        message = "You don't have access to the requested resource. Ensure you are using the correct API key, organization ID, and resource ID."
-    elif error.__class__.__name__ == "RateLimitError":
-        message = "You have hit your assigned rate limit. Pace your requests. Track usage at https://platform.openai.com/usage."
-    elif error.__class__.__name__ == "UnprocessableEntityError":
-        message = "Unable to process the request despite the format being correct. Please try the request again."
-    else:
-        message = "An unknown error occurred."
-
-    print(message)
-    st.error(message)  # Display the error in Streamlit
-
-@st.cache_data
-def calc_costs(model, number, shape):
-    if model == "dall-e-2":
-        if shape == "256x256":
-            return number * 0.016
-        elif shape == "512x512":
-            return number * 0.018
-        elif shape == "1024x1024":
-            return number * 0.02
-    elif model == "dall-e-3":
-        return number * 0.04
-
-def get_byte_array_from_url(url):
-    response = requests.get(url)
-    img = Image.open(BytesIO(response.content))
-    img = img.convert("RGB")
-    image_bytes = BytesIO()
-    img.save(image_bytes, format="PNG")
-    image_bytes = image_bytes.getvalue()
-    return image_bytes
-
-def upload_image_to_cloudflare(image_bytes_array):
-
-    filepath = dt.datetime.now().strftime("%Y/%m/%d/") + str(np.random.randint(10000, 99999))
-
-    # Connect to S3 client
-    S3Connect = boto3.client(
-        's3',
-        endpoint_url=st.secrets['CLOUDFLARE_CONNECTION_URL'],
-        aws_access_key_id=st.secrets['CLOUDFLARE_API_KEY'],
-        aws_secret_access_key=st.secrets['CLOUDFLARE_API_SECRET'],
-        config=Config(signature_version='s3v4'),
+from imaging import variation_png
+from storage import display_image_search, display_upload_status, get_image_store, select_upload_encoding, track_upload
+from result_cache import get_result_cache
+from generation import calc_costs, generate_images_from_prompt, generate_variations, openai_error_message, refine_prompt
+from tracing import span
+
+@st.cache_resource
+def get_openai_client():
+    # Built once per process and shared by every session, so its connection pool survives reruns.
+    # openai is imported here so the page renders without loading it until the first request.
+    from openai import OpenAI
+    return OpenAI(
+        api_key=st.secrets['OPENAI_API_KEY'],
+        organization=st.secrets['OPENAI_ORG'],
+        max_retries=0,  # Retries are handled by the shared scheduler
     )
-    try:
-        # Upload the file
-        response = s3_upload(Bucket=st.secrets['CLOUDFLARE_BUCKET'], 
-            S3Client=S3Connect,
-            TargetFilePath=f"generated_images/{filepath}.png",
-            UploadObject=image_bytes_array,
-            UploadMethod=""
-        )
-        return response
-    except FileNotFoundError:
-        print("The file was not found")
-        return None
 
-#@st.cache_data
-def refine_prompt(_client, prompt):
-    base_prompt = "Refine the following text prompt for an image generation model, describe a captivating but simple image related to the prompt and add more detail and some creative aspects, ideally stylising the image in an interesting way. Be precise with the positioning of the subjects and avoid including too many unrelated details and any text. Return only the detailed text of the prompt to be sent to the image generation model, being as concise as possible and using keywords. The prompt to refine is: "
-    instruction = base_prompt + prompt
-    try:
-        response = _client.chat.completions.create(
-            model="gpt-3.5-turbo-0125",
-            messages=[
-                {"role": "user", "content": instruction}
-            ]
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        print("Failed to refine prompt: " + e)
-        st.write("Failed to refine prompt with error (contact sam.hudson@auctusdigital.co.uk): " + e)        
-        handle_openai_error(e)
-        return prompt
-
-#@st.cache_data
-def generate_images_from_prompt(_client, prompt, number=1, model="dall-e-2", shape="256x256"):
-    image_urls = []
-    for n in range(number):
-        try:
-            response = _client.images.generate(
-                model=model,
-                prompt=prompt,
-                n=1,
-                size=shape
-            )
-            image_urls.append(response.data[0].url)
+def prepare_variation_input(uploaded_image):
+    # Square PNG for the variations API, made once per uploaded file rather than on every rerun.
+    # Only these bytes are kept; the decoded image is dropped as soon as they are encoded. An unusable
+    # upload keeps its error instead, shown on every rerun while that file is selected.
+    cached = st.session_state.get("variation_input")
+    if cached is None or cached[0] != uploaded_image.file_id:
+        error = None
+        with span("prepare_variation_input", track_memory=True, upload_bytes=uploaded_image.size) as s:
             try:
-                upload_image_to_cloudflare(get_byte_array_from_url(response.data[0].url))
-            except:
-                print("Failed to upload image to Cloudflare")
-                st.write("Failed upload image to Cloudflare, please download the image manually")
+                data = variation_png(uploaded_image)
+            except ValueError as e:
+                s.fail(e)
+                data, error = None, str(e)
+            s.set(bytes=len(data) if data else 0)
+        cached = st.session_state["variation_input"] = (uploaded_image.file_id, data, error)
+    if cached[2] is not None:
+        st.error(cached[2])
+    return cached[1]
 
-        except Exception as e:
-            handle_openai_error(e)
-            print("Failed to generate image")
-            print(e)
-            st.write("Failed to refine prompt with error (contact sam.hudson@auctusdigital.co.uk): " + e)
+def handle_openai_error(error):
+    message = openai_error_message(error)
+    print(message)
+    st.error(message)  # Display the error in Streamlit
 
-    return image_urls
+def show_error(message, error=None):
+    # Error callback for the generation core, shown on the page
+    print(message)
+    if error is not None:
+        handle_openai_error(error)
+    st.write(message)
 
-#@st.cache_data
-def generate_variations(_client, _image=None, number=1, model="dall-e-2", shape="256x256"):
-    image_urls = []
-    if model == "dall-e-3":
-        shape = "1024x1024"
-        number = 1
-    try:
-        response = _client.images.create_variation(
-            image=_image,
-            n=number,
-            size=shape
-        )
-        for image in response.data:
-            image_urls.append(image.url)
-            try:
-                upload_image_to_cloudflare(get_byte_array_from_url(image.url))
-            except:
-                print("Failed to upload image to Cloudflare")
-                st.write("Failed upload image to Cloudflare, please download the image manually")
+def track_generated_upload(upload_job):
+    if upload_job is None:
+        st.write("Failed upload image to Cloudflare, please download the image manually")
+    else:
+        track_upload(upload_job)
 
-    except Exception as e:
-        handle_openai_error(e)
-        print("Failed to generate variations")
-        print(e)
-        st.write("Failed to refine prompt with error (contact sam.hudson@auctusdigital.co.uk): " + e)
+calc_costs = st.cache_data(calc_costs)
 
-        return None
-    return image_urls
+def display_cache_stats():
+    stats = get_result_cache().stats()
+    lines = [f"{kind.capitalize()}s: {stats['hits'].get(kind, 0)} hits, {stats['misses'].get(kind, 0)} misses" for kind in ("refinement", "image")]
+    st.sidebar.caption("**Result cache** (since server start)  \n" + "  \n".join(lines) + f"  \n{stats['entries']} entries, {stats['bytes'] / 1e6:.1f} MB")
 
-@st.cache_data(experimental_allow_widgets=True)
-def display_images(image_urls):
+def display_images(image_urls, _store):
+    # The grid shows the session's stored thumbnails, so reruns do not refetch images and expired URLs still show.
+    # The full resolution PNG is only sent once its download is requested, and is only downloaded again on that click.
     image_cols = st.columns(6)
+    downloads = st.session_state.setdefault("prepared_downloads", set())
     for column_i, image_url in enumerate(image_urls):
-        try:
-            image = Image.open(requests.get(image_url, stream=True).raw)
-        except Exception:
-            print(f"Failed to load image: URL has expired or is not an image: {image_url}")
+        thumbnail = _store.thumbnail(image_url)
+        if thumbnail is None:
             continue
 
         col = image_cols[column_i % 6]
-        col.image(image, use_column_width=True)
+        col.image(thumbnail, use_column_width=True)
 
         name = image_url[-10:]
-        buf = BytesIO()
-        image.save(buf, format="PNG")
-        byte_im = buf.getvalue()
-
+        entry = _store.peek(image_url) if image_url in downloads else None
+        if entry is None:
+            downloads.discard(image_url)
+            if not col.button("Full size download", key="prepare_{}".format(name)):
+                continue
+            entry = _store.get(image_url)
+            if entry is None:
+                col.write("The full size image has expired")
+                continue
+            downloads.add(image_url)
         col.download_button(
             label="Download Image",
             key="{}".format(name),
-            data=byte_im,
+            data=entry.png,
             file_name="{}.png".format(name),
             mime="image/png"
         )
 
 def streamlit_app():
     #################################-- INITIALISE APP --#################################
-    client = OpenAI(
-        api_key=st.secrets['OPENAI_API_KEY'],
-        organization=st.secrets['OPENAI_ORG'],
-    )
     st.set_page_config(layout="wide")
     st.title("Image Generation and Refinement")
 
@@ -213,6 +118,8 @@ def streamlit_app():
         st.session_state["generate_images"] = False
         st.session_state['generate_variations'] = False
         st.session_state["initialised"] = True
+    image_store = get_image_store()
+    upload_encoding = select_upload_encoding()
 
     #################################-- IMAGE GENERATION --#################################
     col1, col2 = st.columns(2)
@@ -230,7 +137,10 @@ def streamlit_app():
 
         # Refine the prompt using GPT-3.5, repeated pressing will generate a new prompt
         if st.button("Refine Prompt using GPT-3.5"):
-            st.session_state["prompt"] = refine_prompt(client, st.session_state["initial_prompt"])
+            # The first refinement of a prompt may come from the cache, pressing again asks GPT for a new one
+            force = st.session_state.get("refined_from") == st.session_state["initial_prompt"]
+            st.session_state["prompt"] = refine_prompt(get_openai_client(), st.session_state["initial_prompt"], on_error=show_error, force=force)
+            st.session_state["refined_from"] = st.session_state["initial_prompt"]
 
         # Display the prompt to be sent to the image generation model and allow editing
         if st.session_state.get("prompt") is not None:  
@@ -250,7 +160,20 @@ def streamlit_app():
                 st.session_state["prompt"] = st.session_state["initial_prompt"]
                 st.session_state["generate_images"] = False
 
-            st.session_state["generated_image_urls"].extend(generate_images_from_prompt(client, prompt=st.session_state["prompt"], model=model_to_use, number=number_of_images, shape=image_size))
+            # Show each image as soon as its request completes, the full grid is drawn below once all are done
+            progress = st.empty()
+            progress_cols = progress.container().columns(6)
+            def show_image(i, url, upload_job):
+                track_generated_upload(upload_job)
+                if url in image_store:
+                    progress_cols[i % 6].image(image_store.thumbnail(url), use_column_width=True)
+            # Cached images are reused the first time, generating the same request again makes new ones
+            request = (st.session_state["prompt"], model_to_use, image_size)
+            force = request in st.session_state.setdefault("generated_requests", set())
+            st.session_state["generated_requests"].add(request)
+            with st.spinner(f"Generating {number_of_images} image(s)..."):
+                st.session_state["generated_image_urls"].extend(generate_images_from_prompt(get_openai_client(), prompt=st.session_state["prompt"], model=model_to_use, number=number_of_images, shape=image_size, on_image=show_image, on_error=show_error, _store=image_store, force=force, encoding=upload_encoding))
+            progress.empty()
             st.session_state["generate_images"] = False
         
 
@@ -261,16 +184,12 @@ def streamlit_app():
         #If the user uploads an image, allow them to generate variations on the image
         uploaded_image = sc1.file_uploader("Upload an image as a starting point", type=["png", "jpg", "jpeg"])
         
+        byte_array = None
         if uploaded_image is not None:
-            image = Image.open(uploaded_image)
-            with BytesIO() as buffer:
-                image.save(buffer, format="PNG")
-                buffer.seek(0)
-                image_png = Image.open(buffer)
-                byte_array = buffer.getvalue()  # PNG byte array for further processing
-
-                # Display the converted (or reaffirmed) PNG image
-                sc2.image(image_png, use_column_width=True)
+            byte_array = prepare_variation_input(uploaded_image)
+            if byte_array is not None:
+                # Display the square PNG that will be sent
+                sc2.image(byte_array, use_column_width=True)
                 st.write("Image successfully uploaded and ready for processing.")
 
         option_col_1, option_col_2 = st.columns(2)
@@ -278,18 +197,23 @@ def streamlit_app():
         image_var_size = option_col_2.selectbox("Select variation image size", ["256x256", "512x512", "1024x1024"], index=2)
 
         if st.button("Generate Variations"):
-            if uploaded_image is None:
+            if byte_array is None:
                 st.markdown("<span style=\"color:red\">Please upload an image first</span>", unsafe_allow_html=True)
                 return
             st.session_state['generate_variations'] = True
 
         if st.session_state.get("generate_variations") is True:
-            st.session_state["generated_image_urls"].extend(generate_variations(client, number=number_of_variations, _image=byte_array, shape=image_var_size))
+            st.session_state["generated_image_urls"].extend(generate_variations(get_openai_client(), number=number_of_variations, _image=byte_array, shape=image_var_size,
+                on_image=lambda i, url, upload_job: track_generated_upload(upload_job), on_error=show_error, _store=image_store, encoding=upload_encoding) or [])
             st.session_state["generate_variations"] = False
 
     #Display the images if generated
     if st.session_state.get("generated_image_urls") is not None:
-        display_images(st.session_state["generated_image_urls"])
+        display_images(st.session_state["generated_image_urls"], image_store)
+
+    display_upload_status()
+    display_image_search()
+    display_cache_stats()
     
 if __name__ == "__main__":
     streamlit_app()
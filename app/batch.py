@@ -0,0 +1,240 @@
+# Headless batch mode: turns a file of headlines into captioned thumbnails without the Streamlit UI.
+#
+#   python app/batch.py headlines.csv --out batch_output --model dall-e-3 --size 1792x1024
+#
+# The input is a CSV with a "headline" column or JSONL with a "headline" key. Optional "id" and "text"
+# fields set the output name and the text drawn on the image (the headline by default).
+# With --sizes 1200x630,1080x1080 each image is instead rendered with the auto-fitting layout to every
+# listed size in one pass, with an optional "subheading" field drawn under the text. --design then takes
+# the text style keys in LAYOUT_STYLE_KEYS and the gradient keys in LAYOUT_KEYS; sizes and positions
+# are fitted per output, so the editor's font_size, y_pos and the like are refused.
+# Each headline streams through refine -> generate -> render -> upload, every stage with its own
+# concurrency limit. Progress is appended to manifest.jsonl in the output directory; running the same
+# command again resumes from the last completed stage of each headline.
+import argparse
+import csv
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from openai import OpenAI
+from PIL import Image
+
+from generation import generate_images_from_prompt, refine_prompt
+from imaging import default_design, default_layout, encode_image, export_png, gradient_extent, load_image, render_layout_sizes
+from scheduler import BATCH, batch_limits, configure_scheduler
+from storage import ImageStore, get_secret, queue_upload
+
+STAGE_LIMITS = {"refine": 4, "generate": 4, "render": os.cpu_count() or 2, "upload": 4}
+
+# --design keys used with --sizes: options for both text boxes, and settings for the whole layout
+LAYOUT_STYLE_KEYS = {"font", "align", "valign", "text_color", "outline_color", "outline", "line_spacing", "max_lines",
+                     "shadow_color", "glow_color"}
+LAYOUT_KEYS = {"gradient", "gradient_offset", "gradient_easing", "gradient_color"}
+
+def split_layout_design(design):
+    # (text box style, layout settings) from --design, raising ValueError for keys a fitted layout cannot use
+    unsupported = sorted(set(design) - LAYOUT_STYLE_KEYS - LAYOUT_KEYS)
+    if unsupported:
+        raise ValueError(f"--design keys {', '.join(unsupported)} do not apply with --sizes, where text is fitted to its box")
+    style = {key: value for key, value in design.items() if key in LAYOUT_STYLE_KEYS}
+    settings = {key: value for key, value in design.items() if key in LAYOUT_KEYS}
+    return style, settings
+
+def raise_error(message, error=None):
+    # on_error for the generation core: a failure fails the stage, so a resume retries it instead of
+    # carrying on with a fallback such as the unrefined headline
+    raise RuntimeError(message) from error
+
+def read_headlines(path):
+    if path.endswith(".jsonl") or path.endswith(".json"):
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f))
+
+    items = []
+    for row in rows:
+        headline = (row.get("headline") or "").strip()
+        if not headline:
+            continue
+        item_id = row.get("id") or hashlib.sha1(headline.encode()).hexdigest()[:12]
+        items.append({"id": str(item_id), "headline": headline, "text": row.get("text") or headline,
+                      "subheading": row.get("subheading") or None})
+    return items
+
+class Manifest:
+    # Append-only JSONL log; the last record for an id is that headline's current state
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.state[record["id"]] = record
+
+    def write(self, record):
+        with self.lock:
+            self.state[record["id"]] = record
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+class BatchPipeline:
+    def __init__(self, client, out_dir, model="dall-e-3", shape="1792x1024", number=1, refine=True, upload=True,
+                 design=None, stage_limits=None, sizes=None):
+        self.client = client
+        self.out_dir = out_dir
+        self.model = model
+        self.shape = shape
+        self.number = number
+        self.refine = refine
+        self.upload = upload
+        self.design = design or {}
+        self.sizes = sizes or []
+        if self.sizes:
+            split_layout_design(self.design)  # Refuse unusable keys before anything is generated
+        self.limits = {**STAGE_LIMITS, **(stage_limits or {})}
+        self.stages = {name: threading.Semaphore(limit) for name, limit in self.limits.items()}
+        self.store = ImageStore()
+        os.makedirs(os.path.join(out_dir, "raw"), exist_ok=True)
+        self.manifest = Manifest(os.path.join(out_dir, "manifest.jsonl"))
+
+    def run(self, items):
+        pending = [item for item in items if self.manifest.state.get(item["id"], {}).get("stage") != "done"]
+        print(f"{len(items) - len(pending)} of {len(items)} headlines already done, processing {len(pending)}")
+        with ThreadPoolExecutor(max_workers=max(1, sum(self.limits.values()))) as pool:
+            for record in pool.map(self.process, pending):
+                print(f"{record['id']}: {record['stage']}" + (f" ({record['error']})" if record.get("error") else ""))
+        return self.manifest.state
+
+    def process(self, item):
+        record = {**self.manifest.state.get(item["id"], {}), **item}
+        try:
+            if "prompt" not in record:
+                with self.stages["refine"]:
+                    record["prompt"] = refine_prompt(self.client, item["headline"], on_error=raise_error, priority=BATCH) if self.refine else item["headline"]
+                self.manifest.write({**record, "stage": "refined"})
+
+            if "raw_files" not in record:
+                with self.stages["generate"]:
+                    record["raw_files"] = self.generate(record)
+                self.manifest.write({**record, "stage": "generated"})
+
+            if "outputs" not in record:
+                with self.stages["render"]:
+                    record["outputs"] = [output for raw_file in record["raw_files"] for output in self.render(record, raw_file)]
+                self.manifest.write({**record, "stage": "rendered"})
+
+            if self.upload and "keys" not in record:
+                with self.stages["upload"]:
+                    record["keys"] = self.upload_outputs(record)
+
+            record = {**record, "stage": "done"}
+            record.pop("error", None)
+        except Exception as e:
+            record = {**record, "stage": "failed", "error": str(e)}
+        self.manifest.write(record)
+        return record
+
+    def generate(self, record):
+        # Generated images are saved immediately since their URLs expire after an hour
+        urls = generate_images_from_prompt(self.client, record["prompt"], number=self.number, model=self.model,
+                                           shape=self.shape, _store=self.store, upload=False, priority=BATCH)
+        if len(urls) < self.number:
+            # Failing the stage means a resume retries it; the images that did succeed come back from the result cache
+            raise RuntimeError(f"only {len(urls)} of {self.number} images were generated")
+        raw_files = []
+        for n, url in enumerate(urls):
+            entry = self.store.get(url)
+            if entry is None:
+                raise RuntimeError(f"could not download {url}")
+            raw_file = os.path.join(self.out_dir, "raw", f"{record['id']}-{n}.png")
+            with open(raw_file, "wb") as f:
+                f.write(entry.png)
+            raw_files.append(raw_file)
+        return raw_files
+
+    def render(self, record, raw_file):
+        image = load_image(raw_file)
+        if self.sizes:
+            return self.render_sizes(record, raw_file, image)
+        design = default_design(image.size, record["text"], **self.design)
+        output = os.path.join(self.out_dir, os.path.basename(raw_file))
+        with open(output, "wb") as f:
+            f.write(export_png(image, raw_file, design))
+        return [output]
+
+    def render_sizes(self, record, raw_file, image):
+        # Every size comes from one batch render, which shares the text layers and font fitting between them
+        style, settings = split_layout_design(self.design)
+        layout = default_layout(record["text"], record.get("subheading"), style, **settings)
+        if "gradient_offset" in settings:
+            # Given in pixels of the generated image, as without --sizes; layouts take a fraction of the gradient's axis
+            layout["gradient_offset"] = settings["gradient_offset"] / max(1, gradient_extent(image.size, layout["gradient"]))
+        name = os.path.splitext(os.path.basename(raw_file))[0]
+        outputs = []
+        for size, rendered in zip(self.sizes, render_layout_sizes(image, layout, self.sizes)):
+            output = os.path.join(self.out_dir, f"{name}-{size[0]}x{size[1]}.png")
+            with open(output, "wb") as f:
+                f.write(encode_image(rendered))
+            outputs.append(output)
+        return outputs
+
+    def upload_outputs(self, record):
+        jobs = []
+        for output in record["outputs"]:
+            with Image.open(output) as image:
+                size = f"{image.width}x{image.height}"  # Rendered size, which differs from the generated one with --sizes
+            with open(output, "rb") as f:
+                jobs.append(queue_upload(f.read(), metadata={"prompt": record["prompt"], "model": self.model,
+                                                             "size": size, "source": "batch"}))
+        for job in jobs:
+            job.wait()
+            if job.status == "failed":
+                raise RuntimeError(f"upload failed: {job.error}")
+        return [job.key for job in jobs]
+
+def parse_sizes(value):
+    return [tuple(int(n) for n in size.lower().split("x")) for size in value.split(",") if size.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate captioned thumbnails for a file of headlines")
+    parser.add_argument("headlines", help="CSV with a 'headline' column, or JSONL")
+    parser.add_argument("--out", default="batch_output", help="output directory, also used to resume")
+    parser.add_argument("--model", default="dall-e-3", choices=["dall-e-2", "dall-e-3"])
+    parser.add_argument("--size", default="1792x1024")
+    parser.add_argument("--images", type=int, default=1, help="images per headline")
+    parser.add_argument("--no-refine", action="store_true", help="send headlines to the image model as they are")
+    parser.add_argument("--no-upload", action="store_true", help="skip the Cloudflare upload")
+    parser.add_argument("--design", type=json.loads, default={}, help='JSON overrides for the text design, e.g. \'{"gradient": "Top"}\'')
+    parser.add_argument("--sizes", type=parse_sizes, default=[], help="render every image to these sizes, e.g. 1200x630,1080x1080")
+    for stage, limit in STAGE_LIMITS.items():
+        parser.add_argument(f"--{stage}-concurrency", type=int, default=limit)
+    args = parser.parse_args()
+    if args.sizes:
+        try:
+            split_layout_design(args.design)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # This process' scheduler cannot see the app's queue, so it keeps to its share of the rate limits
+    configure_scheduler(batch_limits())
+    client = OpenAI(
+        api_key=get_secret('OPENAI_API_KEY'),
+        organization=get_secret('OPENAI_ORG'),
+        max_retries=0,  # Retries are handled by the shared scheduler
+    )
+    pipeline = BatchPipeline(client, args.out, model=args.model, shape=args.size, number=args.images,
+                             refine=not args.no_refine, upload=not args.no_upload, design=args.design,
+                             stage_limits={stage: getattr(args, f"{stage}_concurrency") for stage in STAGE_LIMITS},
+                             sizes=args.sizes)
+    pipeline.run(read_headlines(args.headlines))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from result_cache import CACHE_URL_PREFIX, cache_key, get_result_cache
+from scheduler import INTERACTIVE, get_scheduler
+from storage import DEFAULT_UPLOAD_ENCODING, ImageStore, queue_upload
+from tracing import span
+
+# Core OpenAI image generation, kept free of Streamlit so it can run from the pages or headless in batch.py.
+# Failures are passed to an on_error(message, error) callback; the default prints them.
+# Every OpenAI call goes through the shared scheduler, which paces and retries it; priority puts
+# interactive requests ahead of batch jobs. Results are kept in the shared on-disk result cache;
+# force=True skips the cache lookup and replaces the cached result with a fresh one.
+# Each stage is traced; the openai.* spans carry what the call cost at list price, and request spans
+# compare calc_costs' estimate with that actual spend.
+
+# Upper bound on simultaneous image generation requests per user action
+MAX_CONCURRENT_GENERATIONS = 4
+
+REFINE_MODEL = "gpt-3.5-turbo-0125"
+BASE_PROMPT = "Refine the following text prompt for an image generation model, describe a captivating but simple image related to the prompt and add more detail and some creative aspects, ideally stylising the image in an interesting way. Be precise with the positioning of the subjects and avoid including too many unrelated details and any text. Return only the detailed text of the prompt to be sent to the image generation model, being as concise as possible and using keywords. The prompt to refine is: "
+
+OPENAI_ERROR_MESSAGES = {
+    "APIConnectionError": "Issue connecting to OpenAI. Check your network settings, proxy configuration, SSL certificates, or firewall rules.",
+    "APITimeoutError": "Request timed out. Retry your request after a brief wait.",
+    "AuthenticationError": "API key or token was invalid, expired, or revoked. Contact sam.hudson@auctusdigital.co.uk or james.lilley@auctusdigital.co.uk for help.",
+    "BadRequestError": "Your request was malformed or missing some required parameters, such as a token or an input. The error message should advise you on the specific error made. Check the documentation for the specific API method you are calling and make sure you are sending valid and complete parameters. You may also need to check the encoding, format, or size of your request data.",
+    "ConflictError": "The resource was updated by another request. Try to update the resource again and ensure no other requests are trying to update it.",
+    "InternalServerError": "Issue on OpenAI server side. Retry your request after a brief wait.",
+    "NotFoundError": "Requested resource does not exist. Ensure you are the correct resource identifier.",
+    "PermissionDeniedError": "You don't have access to the requested resource. Ensure you are using the correct API key, organization ID, and resource ID.",
+    "RateLimitError": "You have hit your assigned rate limit. Pace your requests. Track usage at https://platform.openai.com/usage.",
+    "UnprocessableEntityError": "Unable to process the request despite the format being correct. Please try the request again.",
+}
+
+def openai_error_message(error):
+    return OPENAI_ERROR_MESSAGES.get(error.__class__.__name__, "An unknown error occurred.")
+
+def print_error(message, error=None):
+    print(message)
+    if error is not None:
+        print(openai_error_message(error))
+        print(error)
+
+# OpenAI list prices in dollars per image, and per million prompt and completion tokens
+IMAGE_PRICES = {
+    ("dall-e-2", "256x256"): 0.016, ("dall-e-2", "512x512"): 0.018, ("dall-e-2", "1024x1024"): 0.02,
+    ("dall-e-3", "1024x1024"): 0.04, ("dall-e-3", "1792x1024"): 0.08, ("dall-e-3", "1024x1792"): 0.08,
+}
+CHAT_PRICES = {REFINE_MODEL: (0.5, 1.5)}
+
+def image_cost(model, shape, number=1):
+    return number * IMAGE_PRICES.get((model, shape), 0.0)
+
+def chat_cost(model, usage):
+    if usage is None:
+        return 0.0
+    prompt_price, completion_price = CHAT_PRICES.get(model, (0.0, 0.0))
+    return (usage.prompt_tokens * prompt_price + usage.completion_tokens * completion_price) / 1e6
+
+def calc_costs(model, number, shape):
+    if model == "dall-e-2":
+        if shape == "256x256":
+            return number * 0.016
+        elif shape == "512x512":
+            return number * 0.018
+        elif shape == "1024x1024":
+            return number * 0.02
+    elif model == "dall-e-3":
+        return number * 0.04
+
+def get_byte_array_from_url(url, _store=None):
+    # PNG bytes for the image at url, read from the image store so each URL is downloaded once
+    with span("get_byte_array_from_url") as s:
+        store = _store or ImageStore()
+        s.set(stored=url in store)
+        entry = store.get(url)
+        if entry is None:
+            raise ValueError(f"Could not download image: {url}")
+        s.set(bytes=len(entry.png))
+        return entry.png
+
+def refine_prompt(_client, prompt, on_error=print_error, priority=INTERACTIVE, force=False):
+    with span("refine_prompt", model=REFINE_MODEL, force=force) as s:
+        key = cache_key(REFINE_MODEL, prompt, BASE_PROMPT)
+        if not force:
+            cached = get_result_cache().get_text("refinement", key)
+            if cached is not None:
+                s.set(cached=True, actual_cost=0.0)
+                return cached
+
+        instruction = BASE_PROMPT + prompt
+        try:
+            with span("openai.chat", model=REFINE_MODEL) as api:
+                response = get_scheduler().call(REFINE_MODEL, _client.chat.completions.create, priority=priority,
+                    model=REFINE_MODEL,
+                    messages=[
+                        {"role": "user", "content": instruction}
+                    ]
+                )
+                cost = chat_cost(REFINE_MODEL, response.usage)
+                api.set(cost=cost, tokens=response.usage.total_tokens if response.usage else None)
+            s.set(cached=False, actual_cost=cost)
+            refined = response.choices[0].message.content
+            get_result_cache().put_text("refinement", key, refined)
+            return refined
+        except Exception as e:
+            on_error("Failed to refine prompt with error (contact sam.hudson@auctusdigital.co.uk): " + str(e), e)
+            s.fail(e)
+            return prompt
+
+def upload_generated_image(image_url, metadata, _store=None, encoding=None):
+    # Queue the image for Cloudflare in the chosen encoding, returning the upload job or None if it could not be downloaded
+    encoding = encoding or DEFAULT_UPLOAD_ENCODING
+    try:
+        entry = (_store or ImageStore()).get(image_url)
+        if entry is None:
+            raise ValueError(f"Could not download image: {image_url}")
+        with span("upload_encode", image_format=encoding["image_format"], compress_level=encoding["compress_level"]) as s:
+            data = entry.encoded(**encoding)
+            s.set(bytes=len(data))
+        return queue_upload(data, metadata=metadata, image_format=encoding["image_format"])
+    except Exception as e:
+        print(f"Failed to queue image for Cloudflare: {e}")
+        return None
+
+def generate_image(_client, prompt, model="dall-e-2", shape="256x256", _store=None, upload=True, priority=INTERACTIVE, variant=0, force=False,
+                   encoding=None):
+    # A single generation request, safe to run on a worker thread.
+    # variant is the image's index within the request, so asking for N images caches N distinct results.
+    with span("generate_image", model=model, shape=shape, variant=variant) as s:
+        key = cache_key(model, prompt, shape, variant)
+        cache = get_result_cache()
+        digest = None if force else cache.image_digest(key)
+        if digest is not None:
+            image_url = CACHE_URL_PREFIX + digest
+            s.set(cached=True)
+        else:
+            with span("openai.images.generate", model=model, shape=shape) as api:
+                response = get_scheduler().call(model, _client.images.generate, priority=priority,
+                    model=model,
+                    prompt=prompt,
+                    n=1,
+                    size=shape
+                )
+                api.set(cost=image_cost(model, shape))
+            image_url = response.data[0].url
+            s.set(cached=False)
+            try:
+                # A forced regeneration is a new entry, so cache:// URLs already shown keep their own image
+                cache.put_image(key, get_byte_array_from_url(image_url, _store))
+            except Exception as e:
+                print(f"Failed to cache generated image: {e}")
+
+        # Cached images are already in the upload index, so this only costs a lookup
+        upload_job = None
+        if upload:
+            upload_job = upload_generated_image(image_url, {"prompt": prompt, "model": model, "size": shape, "source": "generate"}, _store, encoding)
+        return image_url, upload_job
+
+def generate_images_from_prompt(_client, prompt, number=1, model="dall-e-2", shape="256x256", max_workers=MAX_CONCURRENT_GENERATIONS,
+                                on_image=None, on_error=print_error, _store=None, upload=True, priority=INTERACTIVE, force=False,
+                                encoding=None):
+    # Requests run concurrently and are collected as they complete; a failed request does not discard the others.
+    # on_image(index, url, upload_job) is called on the calling thread as each image arrives.
+    image_urls = []
+    with span("generate_images_from_prompt", model=model, shape=shape, number=number,
+              estimated_cost=calc_costs(model, number, shape)) as s:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, number))) as pool:
+            futures = [pool.submit(generate_image, _client, prompt, model, shape, _store, upload, priority, n, force, encoding) for n in range(number)]
+            for future in as_completed(futures):
+                try:
+                    image_url, upload_job = future.result()
+                except Exception as e:
+                    on_error("Failed to generate image with error (contact sam.hudson@auctusdigital.co.uk): " + str(e), e)
+                    s.add("failed", 1)
+                    continue
+
+                image_urls.append(image_url)
+                if on_image is not None:
+                    on_image(len(image_urls) - 1, image_url, upload_job)
+
+        # Only fresh images are billed: failed requests cost nothing and cached ones were paid for before
+        generated = sum(not url.startswith(CACHE_URL_PREFIX) for url in image_urls)
+        s.set(generated=generated, cached=len(image_urls) - generated, actual_cost=image_cost(model, shape, generated))
+
+    return image_urls
+
+def generate_variations(_client, _image=None, number=1, model="dall-e-2", shape="256x256", on_image=None, on_error=print_error, _store=None,
+                        priority=INTERACTIVE, encoding=None):
+    image_urls = []
+    if model == "dall-e-3":
+        shape = "1024x1024"
+        number = 1
+    with span("generate_variations", model="dall-e-2", shape=shape, number=number,
+              estimated_cost=calc_costs("dall-e-2", number, shape)) as s:
+        try:
+            with span("openai.images.create_variation", model="dall-e-2", shape=shape, bytes=len(_image) if isinstance(_image, bytes) else None) as api:
+                response = get_scheduler().call("dall-e-2", _client.images.create_variation, priority=priority,
+                    image=_image,
+                    n=number,
+                    size=shape
+                )
+                api.set(cost=image_cost("dall-e-2", shape, len(response.data)))
+        except Exception as e:
+            on_error("Failed to generate variations with error (contact sam.hudson@auctusdigital.co.uk): " + str(e), e)
+            s.fail(e).set(actual_cost=0.0)
+            return None
+        s.set(generated=len(response.data), actual_cost=image_cost("dall-e-2", shape, len(response.data)))
+
+        for image in response.data:
+            image_urls.append(image.url)
+            upload_job = upload_generated_image(image.url, {"model": "dall-e-2", "size": shape, "source": "variation"}, _store, encoding)
+            if on_image is not None:
+                on_image(len(image_urls) - 1, image.url, upload_job)
+    return image_urls
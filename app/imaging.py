@@ -0,0 +1,565 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFilter, ImageFont, UnidentifiedImageError
+
+FONTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+
+GRADIENT_TYPES = ["Top", "Bottom", "Left", "Right", "Radial", "None"]
+
+# Formats images are saved in, with their file extension and MIME type
+IMAGE_FORMATS = {"PNG": ("png", "image/png"), "WebP": ("webp", "image/webp"), "JPEG": ("jpg", "image/jpeg")}
+
+# Longest side of the grid thumbnails, enough for a 6 column wide layout on a high density screen
+THUMBNAIL_SIZE = 384
+
+# Uploads larger than this many pixels are refused before they are decoded
+MAX_UPLOAD_PIXELS = 50_000_000
+
+# Longest side the text editor decodes uploads at to render size variants, well above every size preset.
+# Its preview decodes smaller still, and full resolution exports decode the upload again at full size.
+MAX_EDIT_SIZE = 4096
+
+# DALL-E 2 variations take a square PNG under 4MB. Their largest output is 1024x1024, so a larger input gains nothing.
+VARIATION_INPUT_SIZE = 1024
+VARIATION_MAX_BYTES = 4 * 1024 * 1024
+
+# Output sizes offered for rendering one layout to several places at once
+SIZE_PRESETS = {"Social card 1200x630": (1200, 630), "Article header 1792x1024": (1792, 1024), "Square 1080x1080": (1080, 1080),
+                "Story 1080x1920": (1080, 1920), "Thumbnail 640x360": (640, 360)}
+
+# Easing curves map the linear 0-1 ramp onto the blend factor
+EASINGS = {
+    "Linear": lambda t: t,
+    "Ease In": lambda t: t * t,
+    "Ease Out": lambda t: 1 - (1 - t) * (1 - t),
+    "Ease In Out": lambda t: t * t * (3 - 2 * t),
+}
+
+def gradient_extent(size, gradient_type):
+    # Length of the axis a gradient's offset is measured along: the width for Left/Right, the height
+    # for Top/Bottom, and the centre to corner distance for Radial. An offset this large draws nothing.
+    width, height = size
+    if gradient_type in ("Left", "Right"):
+        return width
+    if gradient_type in ("Top", "Bottom"):
+        return height
+    if gradient_type == "Radial":
+        return int(math.hypot((width - 1) / 2, (height - 1) / 2))
+    return 0
+
+def _linear_ramp(length, offset, reverse=False):
+    # Ramp runs from 0 at the offset to 1 at the far edge, matching the old per-pixel blend factor
+    span = max(length - offset, 1)
+    ramp = np.clip((np.arange(length, dtype=np.float32) - offset) / span, 0.0, 1.0)
+    if reverse:
+        # Top/Left gradients fade from the edge inwards and stop at length - offset
+        ramp = np.clip(1 - np.arange(length, dtype=np.float32) / span, 0.0, 1.0)
+    return ramp
+
+def gradient_mask(size, gradient_type, gradient_offset=0, easing="Linear"):
+    # Build an "L" mask where 255 means fully blended towards the gradient colour, or None when there
+    # is nothing to blend, as the old per-pixel loops left the image unchanged once the ramp had no length
+    width, height = size
+    if gradient_offset >= gradient_extent(size, gradient_type):
+        return None
+    if gradient_type in ("Top", "Bottom"):
+        ramp = _linear_ramp(height, gradient_offset, reverse=gradient_type == "Top")[:, None]
+    elif gradient_type in ("Left", "Right"):
+        ramp = _linear_ramp(width, gradient_offset, reverse=gradient_type == "Left")[None, :]
+    elif gradient_type == "Radial":
+        # Vignette: clear inside a radius of gradient_offset, fading out to the corners
+        ys, xs = np.ogrid[:height, :width]
+        distance = np.hypot(xs - (width - 1) / 2, ys - (height - 1) / 2).astype(np.float32)
+        span = max(float(distance.max()) - gradient_offset, 1.0)
+        ramp = np.clip((distance - gradient_offset) / span, 0.0, 1.0)
+    else:
+        return None
+
+    ramp = EASINGS[easing](ramp)
+    mask = np.broadcast_to((ramp * 255).astype(np.uint8), (height, width))
+    return Image.fromarray(np.ascontiguousarray(mask), mode="L")
+
+def add_gradient(image, gradient_type, gradient_offset=0, easing="Linear", color="#000000"):
+    mask = gradient_mask(image.size, gradient_type, gradient_offset, easing)
+    return apply_gradient_mask(image, mask, color)
+
+def apply_gradient_mask(image, mask, color="#000000"):
+    # Blend the image towards the colour wherever the mask is set
+    if mask is None:
+        return image
+
+    # Palette and greyscale images are expanded so the blend works per channel, keeping transparency
+    if image.mode == "P":
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    alpha = image.getchannel("A") if image.mode == "RGBA" else None
+    rgb = image.convert("RGB") if alpha is not None else image
+    fill = Image.new("RGB", image.size, ImageColor.getrgb(color)[:3])
+    blended = Image.composite(fill, rgb, mask)
+
+    if alpha is not None:
+        blended.putalpha(alpha)
+    return blended
+
+@lru_cache(maxsize=None)
+def list_fonts(fonts_dir=FONTS_DIR):
+    # The bundled fonts never change while the app is running, so the directory is scanned once
+    return sorted(f for f in os.listdir(fonts_dir) if f.endswith('.ttf') or f.endswith('.otf'))
+
+@lru_cache(maxsize=64)
+def load_font(path, size):
+    # Process-wide cache of parsed fonts, shared by every session
+    return ImageFont.truetype(path, size)
+
+class GlyphMetrics:
+    # Caches glyph advances and kerning pairs for one font so lines can be measured without re-laying them out.
+    # Pillow's basic layout measures a string as the sum of its advances plus the kerning of each adjacent pair.
+    def __init__(self, font):
+        self.font = font
+        self.advances = {}
+        self.kerning = {}
+
+    def advance(self, char):
+        if char not in self.advances:
+            self.advances[char] = self.font.getlength(char)
+        return self.advances[char]
+
+    def kern(self, left, right):
+        pair = left + right
+        if pair not in self.kerning:
+            self.kerning[pair] = self.font.getlength(pair) - self.advance(left) - self.advance(right)
+        return self.kerning[pair]
+
+    def length(self, text):
+        total = sum(self.advance(char) for char in text)
+        for left, right in zip(text, text[1:]):
+            total += self.kern(left, right)
+        return total
+
+@lru_cache(maxsize=64)
+def glyph_metrics(_font):
+    return GlyphMetrics(_font)
+
+def text_length(text, _font):
+    if _font.layout_engine == ImageFont.Layout.RAQM:
+        # Shaped layouts can form ligatures, so the per-glyph sum is not exact
+        return _font.getlength(text)
+    return glyph_metrics(_font).length(text)
+
+def wrap_text(text, max_width, _font):
+    # Split the text into lines based on the maximum width. Each word is measured once and the line
+    # width grows incrementally, rather than re-measuring the whole line for every word.
+    metrics = glyph_metrics(_font)
+    lines = []
+
+    current_line = ''
+    current_width = 0
+    for word in text.split(' '):
+        test_word = word + ' '
+        word_width = text_length(test_word, _font)
+        line_width = current_width + word_width
+        if current_line:
+            line_width += metrics.kern(current_line[-1], test_word[0])
+        # A word wider than the image still starts its own line rather than leaving an empty one
+        if line_width <= max_width or not current_line:
+            current_line += test_word
+            current_width = line_width
+        else:
+            lines.append(current_line[:-1])
+            current_line = test_word
+            current_width = word_width
+
+    lines.append(current_line[:-1])
+    return lines
+
+def fit_font_size(text, max_width, font_path, max_lines, min_size=8, max_size=256):
+    # Binary search the largest font size whose wrapped text fits in max_lines lines.
+    # Returns the size and its line breaks; falls back to min_size if nothing fits.
+    return fit_text_box(text, font_path, max_width, max_lines=max_lines, min_size=min_size, max_size=max_size)
+
+def fit_text_box(text, font_path, max_width, max_height=None, line_spacing=1.0, max_lines=None, min_size=8, max_size=256,
+                 stroke_ratio=0.0):
+    # Largest font size, and its line breaks, at which the wrapped text fits the box. stroke_ratio is the
+    # outline width as a fraction of the font size, which the text needs room for on every side.
+    size, lines = _fit_text_box(text, font_path, max_width, max_height, line_spacing, max_lines, min_size, max_size, stroke_ratio)
+    return size, list(lines)
+
+@lru_cache(maxsize=256)
+def _fit_text_box(text, font_path, max_width, max_height, line_spacing, max_lines, min_size, max_size, stroke_ratio):
+    def fits(size):
+        font = load_font(font_path, size)
+        stroke = 2 * math.ceil(size * stroke_ratio)
+        lines = wrap_text(text, max_width - stroke, font)
+        if max_lines is not None and len(lines) > max_lines:
+            return None
+        if max_height is not None and text_block_height(len(lines), size, line_spacing) + stroke > max_height:
+            return None
+        if any(text_length(line, font) + stroke > max_width for line in lines):
+            return None
+        return lines
+
+    best, best_lines = min_size, None
+    low, high = min_size, max_size
+    while low <= high:
+        size = (low + high) // 2
+        lines = fits(size)
+        if lines is not None:
+            best, best_lines = size, lines
+            low = size + 1
+        else:
+            high = size - 1
+    if best_lines is None:
+        best_lines = wrap_text(text, max_width - 2 * math.ceil(best * stroke_ratio), load_font(font_path, best))
+    return best, tuple(best_lines)
+
+def draw_text_with_outline(_draw, position, text, _font, text_color, outline_color, outline_width):
+    # Pillow strokes the glyphs natively, so each line is rasterised once rather than once per offset
+    _draw.text(position, text, font=_font, fill=text_color, stroke_width=outline_width, stroke_fill=outline_color)
+
+def text_silhouette_mask(size, placements, _font, outline_width):
+    # Single "L" mask of every line including its outline, shared by the shadow and glow effects
+    mask = Image.new("L", size, 0)
+    draw = ImageDraw.Draw(mask)
+    for position, line in placements:
+        draw.text(position, line, font=_font, fill=255, stroke_width=outline_width, stroke_fill=255)
+    return mask
+
+def _color_layer(size, color, mask):
+    # Solid colour with the mask as its alpha, ready for alpha compositing
+    layer = Image.new("RGBA", size, ImageColor.getrgb(color)[:3])
+    layer.putalpha(mask)
+    return layer
+
+def text_block_height(line_count, font_size, line_spacing):
+    return int(font_size * line_count * line_spacing)
+
+def text_layer(width, sentence, _font, font_size, line_spacing, text_color, outline_color, outline_width=8, lines=None,
+               shadow_color=None, shadow_offset=(8, 8), shadow_blur=8, glow_color=None, glow_radius=12, align="center"):
+    # Render the wrapped text block onto a transparent layer the width of the image, or with width=None
+    # onto one just wide enough for the longest line and the padding on each side. Lines are aligned within it.
+    # Pass lines to reuse line breaks decided elsewhere, e.g. at full resolution for a scaled preview.
+    # Returns the layer, the padding around the text and the number of lines.
+    wrapped_text = lines if lines is not None else wrap_text(sentence, width, _font)
+
+    # Pad the layer so the outline, shadow and glow are not clipped
+    pad = outline_width
+    if glow_color is not None:
+        pad += glow_radius * 2
+    if shadow_color is not None:
+        pad += shadow_blur * 2 + max(abs(shadow_offset[0]), abs(shadow_offset[1]))
+    ascent, descent = _font.getmetrics()
+    line_height = int(font_size * line_spacing)
+    height = pad * 2 + line_height * (len(wrapped_text) - 1) + ascent + descent
+
+    # Calculate the position of each line
+    line_widths = [text_length(line, _font) for line in wrapped_text]
+    margin = 0
+    if width is None:
+        margin = pad
+        width = math.ceil(max(line_widths)) + pad * 2
+    inner_width = width - margin * 2
+    placements = []
+    y = pad
+    for line, line_width in zip(wrapped_text, line_widths):
+        if align == "left":
+            x = margin
+        elif align == "right":
+            x = margin + inner_width - line_width
+        else:
+            x = margin + (inner_width - line_width) // 2
+        placements.append(((x, y), line))
+        y += line_height
+
+    # Transparent pixels carry the outline colour so the antialiased edge does not fringe towards black
+    layer = Image.new("RGBA", (width, height), ImageColor.getrgb(outline_color)[:3] + (0,))
+
+    # Shadow and glow sit underneath the text and come from the same silhouette mask
+    if shadow_color is not None or glow_color is not None:
+        silhouette = text_silhouette_mask(layer.size, placements, _font, outline_width)
+        if glow_color is not None:
+            glow = silhouette.filter(ImageFilter.GaussianBlur(glow_radius))
+            glow = glow.point(lambda v: min(255, v * 2))
+            layer = Image.alpha_composite(layer, _color_layer(layer.size, glow_color, glow))
+        if shadow_color is not None:
+            shadow = silhouette.filter(ImageFilter.GaussianBlur(shadow_blur)) if shadow_blur > 0 else silhouette
+            shifted = Image.new("L", layer.size, 0)
+            shifted.paste(shadow, shadow_offset)
+            shadow = shifted
+            layer = Image.alpha_composite(layer, _color_layer(layer.size, shadow_color, shadow))
+
+    # Draw the text
+    draw = ImageDraw.Draw(layer)
+    for position, line in placements:
+        draw_text_with_outline(draw, position, line, _font, text_color, outline_color, outline_width)
+
+    return layer, pad, len(wrapped_text)
+
+def text_block_position(image, pad, line_count, y_offset, font_size, line_spacing):
+    # Centre the text block vertically, then shift it by y_offset
+    y = (image.height - text_block_height(line_count, font_size, line_spacing)) // 2 + y_offset - pad
+    return (0, y)
+
+def add_text_to_image(image, y_offset, sentence, _font, font_size, line_spacing, text_color, outline_color, outline_width=8, **options):
+    layer, pad, line_count = text_layer(image.width, sentence, _font, font_size, line_spacing, text_color, outline_color, outline_width, **options)
+    _paste_layer(image, layer, text_block_position(image, pad, line_count, y_offset, font_size, line_spacing))
+
+def open_upload(file, max_pixels=MAX_UPLOAD_PIXELS):
+    # Read only the header of an uploaded image, refusing anything that is not an image or is too large to decode.
+    # Raises ValueError with a message for the user.
+    try:
+        image = Image.open(file)
+    except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Not a usable image: {e}") from e
+    if image.width * image.height > max_pixels:
+        raise ValueError(f"The image is {image.width}x{image.height}, over the {max_pixels // 1_000_000} megapixel limit")
+    return image
+
+def _decode_reduced(image, size, mode):
+    # Decode straight to roughly the requested size where the format allows it: JPEGs are decoded at 1/2, 1/4
+    # or 1/8 scale in draft mode, staying at least as large as size. The mode is only converted when it
+    # differs, since convert() copies the pixels even when it has nothing to do.
+    # A truncated or corrupt file only fails here, so that is raised as a ValueError like open_upload's.
+    try:
+        if size[0] < image.width and size[1] < image.height:
+            image.draft(mode, size)
+        if image.mode != mode:
+            return image.convert(mode)
+        image.load()
+        return image
+    except OSError as e:
+        raise ValueError(f"Not a usable image: {e}") from e
+
+def load_image(file, max_size=None):
+    # Decode an image file into RGB, or RGBA when it carries transparency, no larger than max_size on its longest side.
+    # Larger JPEGs are drafted to the smallest reduced decode that still covers max_size, then resampled down to it.
+    image = open_upload(file)
+    mode = "RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB"
+    if max_size is None or max(image.size) <= max_size:
+        return _decode_reduced(image, image.size, mode)
+    scale = max_size / max(image.size)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    image = _decode_reduced(image, size, mode)
+    if image.size == size:
+        return image
+    return image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+
+def variation_png(file, size=VARIATION_INPUT_SIZE):
+    # The square PNG DALL-E 2 variations need: centre-cropped, no larger than size, and under the API's 4MB limit.
+    # Transparency is dropped, as variations ignore it and RGBA could exceed the limit at 1024x1024.
+    image = open_upload(file)
+    side = min(size, *image.size)
+    scale = side / min(image.size)
+    image = _decode_reduced(image, (math.ceil(image.width * scale), math.ceil(image.height * scale)), "RGB")
+    data = encode_image(fit_image(image, (side, side)))
+    if len(data) > VARIATION_MAX_BYTES:
+        raise ValueError(f"The image is {len(data) / 1e6:.1f}MB as a PNG, over the 4MB limit for variations")
+    return data
+
+def _paste_layer(image, layer, position):
+    # Composite in place; RGBA images need alpha_composite so their own alpha is not reduced
+    x, y = position
+    if image.mode == "RGBA":
+        image.alpha_composite(layer, (max(x, 0), max(y, 0)), (max(-x, 0), max(-y, 0)))
+    else:
+        image.paste(layer, position, layer)
+
+def composite_layer(image, layer, position=(0, 0)):
+    # Return a copy of the image with a transparent layer composited on top
+    composite = image.copy()
+    if layer is not None:
+        _paste_layer(composite, layer, position)
+    return composite
+
+def default_design(size, text, **overrides):
+    # The text editor's starting settings for an image of this size
+    width, height = size
+    design = {
+        "text": text, "font": "Gotham Ultra.otf", "font_size": int(width*0.1), "text_color": "#FFFFFF",
+        "outline_color": "#000000", "outline_width": 8, "line_spacing": 1.0, "y_pos": int(height*0.3),
+        "gradient": "Bottom", "gradient_easing": "Linear", "gradient_color": "#000000",
+        "shadow_color": None, "shadow_offset": (8, 8), "shadow_blur": 8, "glow_color": None, "glow_radius": 12,
+    }
+    design.update(overrides)
+    # Halfway along whichever axis the chosen gradient runs
+    design.setdefault("gradient_offset", gradient_extent(size, design["gradient"]) // 2)
+    return design
+
+def scale_design(design, scale):
+    # Scale every pixel measurement so a proxy render lays out like the full size image
+    if scale == 1.0:
+        return design
+    scaled = dict(design)
+    scaled["font_size"] = max(1, round(design["font_size"] * scale))
+    for key in ("outline_width", "y_pos", "gradient_offset", "shadow_blur", "glow_radius"):
+        scaled[key] = round(design[key] * scale)
+    scaled["glow_radius"] = max(1, scaled["glow_radius"])
+    scaled["shadow_offset"] = tuple(round(v * scale) for v in design["shadow_offset"])
+    return scaled
+
+def render_design(image, image_id, design, lines=None, layer_cache=None):
+    # Gradient then text, built from layers that the caller may cache between reruns
+    layer = layer_cache or (lambda name, key, build: build())
+    size = image.size
+    if lines is None:
+        lines = wrap_text(design["text"], size[0], load_font(os.path.join(FONTS_DIR, design["font"]), design["font_size"]))
+
+    gradient_key = (design["gradient"], design["gradient_offset"], design["gradient_easing"], size)
+    gradient_layer = layer("gradient", gradient_key,
+        lambda: gradient_mask(size, design["gradient"], design["gradient_offset"], design["gradient_easing"]))
+    graded_key = (image_id, gradient_key, design["gradient_color"])
+    graded_image = layer("graded", graded_key,
+        lambda: apply_gradient_mask(image, gradient_layer, design["gradient_color"]))
+
+    text_settings = {k: v for k, v in design.items() if not k.startswith("gradient") and k != "y_pos"}
+    text_key = (tuple(text_settings.items()), tuple(lines), size[0])
+    text_overlay, text_pad, line_count = layer("text", text_key,
+        lambda: text_layer(size[0], design["text"], load_font(os.path.join(FONTS_DIR, design["font"]), design["font_size"]),
+                           design["font_size"], design["line_spacing"], design["text_color"], design["outline_color"], design["outline_width"],
+                           lines=lines, shadow_color=design["shadow_color"], shadow_offset=design["shadow_offset"], shadow_blur=design["shadow_blur"],
+                           glow_color=design["glow_color"], glow_radius=design["glow_radius"]))
+
+    #Composite the text layer over the graded image at the chosen Y position
+    position = text_block_position(graded_image, text_pad, line_count, design["y_pos"], design["font_size"], design["line_spacing"])
+    return layer("final", (graded_key, text_key, design["y_pos"]),
+        lambda: composite_layer(graded_image, text_overlay, position))
+
+def text_box(text, x=0.05, y=0.55, width=0.9, height=0.3, font="Gotham Ultra.otf", align="center", valign="middle",
+             text_color="#FFFFFF", outline_color="#000000", outline=0.06, line_spacing=1.0, max_lines=None,
+             shadow_color=None, glow_color=None):
+    # One block of text in a layout. The box and every effect are relative (to the output size and the
+    # fitted font size respectively), so the same box lays out sensibly on any output size.
+    return {"text": text, "x": x, "y": y, "width": width, "height": height, "font": font, "align": align, "valign": valign,
+            "text_color": text_color, "outline_color": outline_color, "outline": outline, "line_spacing": line_spacing,
+            "max_lines": max_lines, "shadow_color": shadow_color, "glow_color": glow_color}
+
+def default_layout(headline, subheading=None, style=None, **overrides):
+    # A headline over a bottom gradient, with an optional smaller subheading underneath it.
+    # style holds text_box options, such as the font and colours, shared by both boxes and overriding their defaults.
+    # gradient_offset is a fraction of the gradient's axis, see layout_gradient_offset.
+    style = style or {}
+    boxes = [text_box(headline, **{"y": 0.5 if subheading else 0.55, "height": 0.3, "max_lines": 3, **style})]
+    if subheading:
+        boxes.append(text_box(subheading, **{"y": 0.82, "height": 0.1, "max_lines": 2, "outline": 0.05, **style}))
+    layout = {"boxes": boxes, "gradient": "Bottom", "gradient_offset": 0.5, "gradient_easing": "Linear", "gradient_color": "#000000"}
+    layout.update(overrides)
+    return layout
+
+def layout_gradient_offset(layout, size):
+    # A layout's gradient offset is a fraction of the axis its gradient runs along, e.g. the width for
+    # Left and Right, so the gradient covers the same share of every output size
+    return round(layout["gradient_offset"] * gradient_extent(size, layout["gradient"]))
+
+def fit_image(image, size):
+    # Crop to the target aspect ratio around the centre, then resize, so the output is filled without distortion
+    if image.size == tuple(size):
+        return image
+    width, height = size
+    scale = max(width / image.width, height / image.height)
+    crop_width, crop_height = width / scale, height / scale
+    left, top = max(0, (image.width - crop_width) / 2), max(0, (image.height - crop_height) / 2)
+    return image.resize((width, height), Image.LANCZOS, box=(left, top, left + crop_width, top + crop_height), reducing_gap=2.0)
+
+def place_text_box(box, size):
+    # The box in pixels for an output size, with its fitted font size and line breaks
+    width, height = size
+    x, y = round(box["x"] * width), round(box["y"] * height)
+    box_width, box_height = max(1, round(box["width"] * width)), max(1, round(box["height"] * height))
+    font_size, lines = fit_text_box(box["text"], os.path.join(FONTS_DIR, box["font"]), box_width, box_height, box["line_spacing"],
+                                    box["max_lines"], max_size=max(8, box_height), stroke_ratio=box["outline"])
+    return {"x": x, "y": y, "width": box_width, "height": box_height, "font_size": font_size, "lines": lines}
+
+def text_box_layer(box, font_size, lines):
+    # Tight layer for one box at one font size; effects scale with the font size
+    outline_width = max(1, round(font_size * box["outline"])) if box["outline"] else 0
+    effect = max(1, round(font_size * 0.05))
+    return text_layer(None, box["text"], load_font(os.path.join(FONTS_DIR, box["font"]), font_size), font_size, box["line_spacing"],
+                      box["text_color"], box["outline_color"], outline_width, lines=lines, shadow_color=box["shadow_color"],
+                      shadow_offset=(effect, effect), shadow_blur=effect, glow_color=box["glow_color"], glow_radius=effect * 2,
+                      align=box["align"])
+
+def text_box_position(box, placed, layer, pad):
+    # Top left corner of the layer so its text block sits in the box with the requested alignment
+    inner_width = layer.width - pad * 2
+    block_height = text_block_height(len(placed["lines"]), placed["font_size"], box["line_spacing"])
+    if box["align"] == "left":
+        x = placed["x"]
+    elif box["align"] == "right":
+        x = placed["x"] + placed["width"] - inner_width
+    else:
+        x = placed["x"] + (placed["width"] - inner_width) // 2
+    if box["valign"] == "top":
+        y = placed["y"]
+    elif box["valign"] == "bottom":
+        y = placed["y"] + placed["height"] - block_height
+    else:
+        y = placed["y"] + (placed["height"] - block_height) // 2
+    return (x - pad, y - pad)
+
+def render_layout(image, layout, size=None):
+    return render_layout_sizes(image, layout, [size or image.size])[0]
+
+def render_layout_sizes(image, layout, sizes, max_workers=None):
+    # Render one layout at every output size and return the images in the same order.
+    # Fonts and fitting searches are cached, and each gradient mask and each text layer is built once
+    # for all the outputs that need it: outputs whose boxes fit to the same font size and line breaks,
+    # such as sizes of the same width, share the layer. Layers are never resampled between sizes, since
+    # that costs about as much as drawing them and softens the text. The outputs are then resized and
+    # composited on a thread each, up to one per CPU, as Pillow releases the GIL for that work.
+    # Presets of different widths fit to different font sizes, so they rarely share a layer and glyphs
+    # are drawn per output: on one CPU a batch costs about the same as separate renders, not much less.
+    sizes = [tuple(size) for size in sizes]
+    placements = {size: [place_text_box(box, size) for box in layout["boxes"]] for size in set(sizes)}
+    layers = {}
+    for size in placements:
+        for index, placed in enumerate(placements[size]):
+            key = (index, placed["font_size"], tuple(placed["lines"]))
+            if key not in layers:
+                layer, pad, _ = text_box_layer(layout["boxes"][index], placed["font_size"], placed["lines"])
+                layers[key] = (layer, pad)
+    masks = {size: gradient_mask(size, layout["gradient"], layout_gradient_offset(layout, size), layout["gradient_easing"])
+             for size in placements}
+
+    def render(size):
+        output = apply_gradient_mask(fit_image(image, size), masks[size], layout["gradient_color"])
+        if output is image:
+            output = image.copy()  # Without a gradient or a resize this is still the caller's image
+        for index, placed in enumerate(placements[size]):
+            layer, pad = layers[(index, placed["font_size"], tuple(placed["lines"]))]
+            _paste_layer(output, layer, text_box_position(layout["boxes"][index], placed, layer, pad))
+        return output
+
+    workers = max_workers or min(len(sizes), os.cpu_count() or 1)
+    if workers <= 1:
+        return [render(size) for size in sizes]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(render, sizes))
+
+def encode_image(image, image_format="PNG", compress_level=6, quality=90):
+    # compress_level trades PNG encode time for size (1 is fastest); WebP at quality 100 is lossless
+    buf = BytesIO()
+    if image_format == "PNG":
+        image.save(buf, format="PNG", compress_level=compress_level)
+    elif image_format == "WebP":
+        image.save(buf, format="WEBP", quality=quality, lossless=quality >= 100)
+    else:
+        image.convert("RGB").save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+def make_thumbnail(image, max_size=THUMBNAIL_SIZE, image_format="WebP", quality=80):
+    # Small preview for grids, so the page never ships or re-encodes the full resolution image to show it
+    thumbnail = image.copy()
+    thumbnail.thumbnail((max_size, max_size), Image.LANCZOS, reducing_gap=2.0)
+    return encode_image(thumbnail, image_format, quality=quality)
+
+def export_image(image, image_id, design, lines=None, image_format="PNG", compress_level=6, quality=90):
+    return encode_image(render_design(image, image_id, design, lines), image_format, compress_level, quality)
+
+def export_png(image, image_id, design, lines=None):
+    return export_image(image, image_id, design, lines)
@@ -1,110 +1,68 @@
 import streamlit as st
 import datetime as dt
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
-from io import BytesIO
 import os
-import boto3
-from botocore.client import Config
-from dataplane import s3_upload
-
-def upload_image_to_cloudflare(image_bytes_array):
-
-    filepath = dt.datetime.now().strftime("%Y/%m/%d/") + str(np.random.randint(10000, 99999))
-
-    # Connect to S3 client
-    S3Connect = boto3.client(
-        's3',
-        endpoint_url=st.secrets['CLOUDFLARE_CONNECTION_URL'],
-        aws_access_key_id=st.secrets['CLOUDFLARE_API_KEY'],
-        aws_secret_access_key=st.secrets['CLOUDFLARE_API_SECRET'],
-        config=Config(signature_version='s3v4'),
-    )
-    try:
-        # Upload the file
-        response = s3_upload(Bucket=st.secrets['CLOUDFLARE_BUCKET'], 
-            S3Client=S3Connect,
-            TargetFilePath=f"generated_images/{filepath}.png",
-            UploadObject=image_bytes_array,
-            UploadMethod=""
-        )
-        return response
-    except FileNotFoundError:
-        print("The file was not found")
-        return None
-
-def wrap_text(text, max_width, _font):
-    # Split the text into lines based on the maximum width
-    lines = []
-    words = text.split(' ')
-    
-    current_line = ''
-    for word in words:
-        test_line = current_line + word + ' '
-        line_width = _font.getlength(test_line)
-        if line_width <= max_width:
-            current_line = test_line
-        else:
-            lines.append(current_line[:-1])
-            current_line = word + ' '
- 
-    lines.append(current_line[:-1])
-    return lines
-
-def draw_text_with_outline(_draw, position, text, _font, text_color, outline_color, outline_width):
-    # Draw outline by offsetting the text position in all directions
-    x, y = position
-    for dx in range(-outline_width, outline_width+1):
-        for dy in range(-outline_width, outline_width+1):
-            if dx == 0 and dy == 0:
-                continue  # Skip the offset for the main text
-            _draw.text((x + dx, y + dy), text, font=_font, fill=outline_color)
-    # Draw the main text
-    _draw.text((x, y), text, font=_font, fill=text_color)
-
-def add_text_to_image(image, y_offset, sentence, _font, font_size, line_spacing, text_color, outline_color, outline_width=8):
-    
-    # Apply line wrap if the text is longer than the image width
-    max_width = int(image.width)
-    wrapped_text = wrap_text(sentence, max_width, _font)
-    
-    # Calculate the vertical position of the text
-    draw = ImageDraw.Draw(image)
-    y = (image.height - int(font_size * len(wrapped_text) * line_spacing)) // 2 + y_offset
-    
-    # Draw the text
-    for line in wrapped_text:
-        line_width = _font.getlength(line)  # Use getlength for Pillow >= 8.0.0
-        x = (image.width - line_width) // 2
-        draw_text_with_outline(draw, (x, y), line, _font, text_color, outline_color, outline_width)
-        y += int(font_size * line_spacing)
-
-@st.cache_data
-def add_gradient(image, gradient_type, gradient_offset=0):
-    # Load the image and get its size
-    width, height = image.size
-    pixels = image.load()  # Load pixel data
-    
-    if gradient_type == "Top":
-        for y in range(height - gradient_offset):
-            for x in range(width):
-                blend_factor = 1 - ((y) / (height - gradient_offset))
-                pixels[x, y] = tuple([int(c * (1-blend_factor)) for c in pixels[x, y][:3]])  # Blend towards black
-    
-    elif gradient_type == "Bottom":
-        for y in range(gradient_offset, height):
-            for x in range(width):
-                blend_factor = (y - gradient_offset) / (height - gradient_offset)
-                pixels[x, y] = tuple([int(c * (1-blend_factor)) for c in pixels[x, y][:3]])  # Blend towards black
-
-    return image
+from imaging import (GRADIENT_TYPES, EASINGS, FONTS_DIR, MAX_EDIT_SIZE, SIZE_PRESETS, default_layout, encode_image, export_image, fit_font_size,
+                     gradient_extent, list_fonts, load_font, load_image, open_upload, render_design, render_layout_sizes, scale_design, wrap_text)
+from storage import display_upload_status, queue_upload, select_upload_encoding, track_upload
+from tracing import span
+
+# Width the on-screen preview is rendered at; the export is always full resolution
+PREVIEW_WIDTH = 800
+
+def cached_layer(name, key, build, track_memory=False):
+    # Keep each render layer in session state and rebuild it only when its key changes
+    layers = st.session_state.setdefault("layers", {})
+    if name not in layers or layers[name][0] != key:
+        with span(f"add_text.{name}", track_memory):
+            layers[name] = (key, build())
+    return layers[name][1]
+
+def export_full_resolution(uploaded_image, design, lines, image_format="PNG", compress_level=6, quality=90):
+    # The upload is decoded again at full size for each export rather than kept decoded between reruns
+    with span("add_text.export", track_memory=True, image_format=image_format) as s:
+        image = load_image(uploaded_image)
+        data = export_image(image, uploaded_image.file_id, design, lines, image_format, compress_level, quality)
+        s.set(width=image.width, height=image.height, bytes=len(data))
+    return data
+
+def size_variants(uploaded_image, size, design):
+    # Renders the current text, auto-fitted with an optional subheading, to several output sizes at once
+    with st.expander("Size variants"):
+        subheading = st.text_input("Subheading (optional)", "")
+        v1, v2 = st.columns(2)
+        align = v1.selectbox("Alignment", ["center", "left", "right"])
+        presets = v2.multiselect("Sizes", list(SIZE_PRESETS), default=list(SIZE_PRESETS)[:3])
+        style = {"font": design["font"], "align": align, "text_color": design["text_color"], "outline_color": design["outline_color"],
+                 "line_spacing": design["line_spacing"], "shadow_color": design["shadow_color"], "glow_color": design["glow_color"]}
+        # The editor's offset is in pixels along the gradient's axis; layouts take it as a fraction of that axis
+        gradient_offset = design["gradient_offset"] / max(1, gradient_extent(size, design["gradient"]))
+        layout = default_layout(design["text"], subheading or None, style, gradient=design["gradient"], gradient_easing=design["gradient_easing"],
+                                gradient_color=design["gradient_color"], gradient_offset=gradient_offset)
+
+        variants_key = (uploaded_image.file_id, repr(layout), tuple(presets))
+        if st.button("Render size variants", disabled=not presets):
+            sizes = [SIZE_PRESETS[preset] for preset in presets]
+            with span("add_text.size_variants", track_memory=True, sizes=len(sizes)) as s:
+                rendered = render_layout_sizes(load_image(uploaded_image, MAX_EDIT_SIZE), layout, sizes)
+                outputs = [(preset, encode_image(output)) for preset, output in zip(presets, rendered)]
+                s.set(bytes=sum(len(data) for _, data in outputs))
+            st.session_state["size_variants"] = (variants_key, outputs)
+
+        variants = st.session_state.get("size_variants")
+        if variants is not None and variants[0] == variants_key:
+            columns = st.columns(len(variants[1]))
+            for column, (preset, data) in zip(columns, variants[1]):
+                width, height = SIZE_PRESETS[preset]
+                column.image(data, caption=preset, use_column_width=True)
+                column.download_button("Download", data, file_name=f"image-{width}x{height}.png", mime="image/png", key=f"variant-{preset}")
 
 def main():
     #################################-- INITIALISE APP --#################################
     st.set_page_config(layout="wide")
     # Load fonts from local directory
-    fonts_dir = 'app/fonts'
-    fonts = [f for f in os.listdir(fonts_dir) if f.endswith('.ttf') or f.endswith('.otf')]
+    fonts = list_fonts()
+    upload_encoding = select_upload_encoding()
 
     logo = True
     if logo:
@@ -121,59 +79,105 @@ def main():
 
     if uploaded_image is not None:
         with col1:
-            #Display the uploaded image and text box
-            image = Image.open(uploaded_image)
+            #Display the uploaded image and text box. Only the header is read for its dimensions, and the image is
+            #decoded at preview size once per uploaded file; exports decode it again at full resolution.
+            try:
+                width, height = cached_layer("size", uploaded_image.file_id, lambda: open_upload(uploaded_image).size)
+                scale = min(1.0, PREVIEW_WIDTH / width)
+                preview_base = cached_layer("preview_base", (uploaded_image.file_id, scale),
+                    lambda: load_image(uploaded_image, max(1, round(max(width, height) * scale))), track_memory=True)
+            except ValueError as e:
+                st.error(str(e))
+                return
             s1, s2 = st.columns((11, 3))
             text = s1.text_input("Text to add:", "THIS IS SOME REALLY LONG TEXT")
             selected_font = s2.selectbox("Choose a font", fonts, index=2)
 
-            #Get uploaded image dimensions
-            width, height = image.size
-            
             #Options for the text
             o1, o2, o3, o4, o5, o6 = st.columns((1, 1, 3, 3, 3, 3))
             text_color = o1.color_picker("Text Color", "#FFFFFF")
             outline_color = o2.color_picker("Outline Color", "#000000")
-            font_size = o3.number_input("Font Size", 0, 256, int(width*0.1), step=10)
+            font_limit = max(256, width // 4)
+            font_size = o3.number_input("Font Size", 0, font_limit, int(width*0.1), step=10)
+            fit_lines = o4.number_input("Auto-fit to lines (0 = off)", 0, 10, 0)
             outline_width = o4.number_input("Outline Width", 1, 16, 8)
             line_spacing = o5.number_input("Line Spacing", 0.0, 5.0, 1.0, step=0.1)
             y_pos = o6.number_input("Y Position", -height, height, int(height*0.3), step=10)
 
-            gradient_offset = o5.number_input("Gradient Offset", 0, height, int(height/2), step=50)
-            gradient = o6.selectbox("Gradient", ["Top", "Bottom", "None"], index=1)
-
-            font_path = os.path.join(fonts_dir, selected_font)
-            font = ImageFont.truetype(font_path, font_size)
-
-            editable_image = image.copy()
-
-            #Add gradient
-            editable_image = add_gradient(editable_image, gradient, gradient_offset)
-
-            #Draw centred and wrapped text
-            add_text_to_image(editable_image, y_pos, text, font, font_size, line_spacing, text_color, outline_color, outline_width)
+            #The offset is measured along the gradient's own axis, e.g. the width for Left and Right
+            gradient = o6.selectbox("Gradient", GRADIENT_TYPES, index=1)
+            offset_limit = gradient_extent((width, height), gradient)
+            gradient_offset = o5.number_input("Gradient Offset", 0, offset_limit, offset_limit // 2, step=50)
+            gradient_easing = o3.selectbox("Gradient Easing", list(EASINGS), index=0)
+            gradient_color = o4.color_picker("Gradient Color", "#000000")
+
+            #Optional shadow and glow effects behind the text
+            e1, e2, e3, e4 = st.columns(4)
+            shadow_color = e1.color_picker("Shadow Color", "#000000") if e1.checkbox("Shadow") else None
+            shadow_blur = e2.number_input("Shadow Blur", 0, 64, 8)
+            glow_color = e3.color_picker("Glow Color", "#FFFF00") if e3.checkbox("Glow") else None
+            glow_radius = e4.number_input("Glow Radius", 1, 64, 12)
+
+            design = {
+                "text": text, "font": selected_font, "font_size": font_size, "text_color": text_color,
+                "outline_color": outline_color, "outline_width": outline_width, "line_spacing": line_spacing,
+                "y_pos": y_pos, "gradient": gradient, "gradient_offset": gradient_offset,
+                "gradient_easing": gradient_easing, "gradient_color": gradient_color, "shadow_color": shadow_color,
+                "shadow_offset": (8, 8), "shadow_blur": shadow_blur, "glow_color": glow_color, "glow_radius": glow_radius,
+            }
+
+            #Line breaks are always decided at full resolution so the preview wraps exactly like the export.
+            #Auto-fit goes up to the same limit as the font size input and leaves room for the outline on both sides.
+            font_path = os.path.join(FONTS_DIR, selected_font)
+            if fit_lines > 0:
+                design["font_size"], lines = cached_layer("lines", ("fit", text, selected_font, fit_lines, width, outline_width),
+                    lambda: fit_font_size(text, max(1, width - 2 * outline_width), font_path, fit_lines, max_size=font_limit))
+            else:
+                lines = cached_layer("lines", (text, selected_font, font_size, width),
+                    lambda: wrap_text(text, width, load_font(font_path, font_size)))
+
+            #Render the design scaled down onto the preview sized decode
+            with span("add_text.render_preview", width=preview_base.width, height=preview_base.height):
+                preview_image = render_design(preview_base, uploaded_image.file_id, scale_design(design, scale), lines, cached_layer)
     
     #################################-- IMAGE DISPLAY --#################################
 
         #Display the edited image on the right of the screen
         with col2:
-            col2.image(editable_image, use_column_width=True)
-            
-            # Save and download functionality
-            buf = BytesIO()
-            editable_image.save(buf, format="PNG")
-            byte_im = buf.getvalue()
-            timestamp = dt.datetime.now().strftime("%Y%m%d-%H%M%S") + '-'+str(np.random.randint(1000, 9999))
-            col2.download_button(
-                label="Download image",
-                data=byte_im,
-                file_name="image-{}.png".format(timestamp),
-                mime="image/png"
-            )
+            col2.image(preview_image, use_column_width=True)
+
+            # The full resolution composite and PNG encode only run when the user exports the image
+            export_key = (uploaded_image.file_id, tuple(design.items()))
+            if col2.button("Prepare full resolution download"):
+                st.session_state["export"] = (export_key, export_full_resolution(uploaded_image, design, lines))
+
+            export = st.session_state.get("export")
+            if export is not None and export[0] == export_key:
+                timestamp = dt.datetime.now().strftime("%Y%m%d-%H%M%S") + '-'+str(np.random.randint(1000, 9999))
+                col2.download_button(
+                    label="Download image",
+                    data=export[1],
+                    file_name="image-{}.png".format(timestamp),
+                    mime="image/png"
+                )
 
             if col2.button("Save Image to cloudflare"):
-                print(upload_image_to_cloudflare(byte_im))
-                st.write("Image saved to cloudflare")
+                # The prepared PNG is reused unless another upload encoding was chosen
+                if upload_encoding["image_format"] == "PNG" and upload_encoding["compress_level"] is None:
+                    if export is None or export[0] != export_key:
+                        export = (export_key, export_full_resolution(uploaded_image, design, lines))
+                        st.session_state["export"] = export
+                    upload_bytes = export[1]
+                else:
+                    upload_bytes = export_full_resolution(uploaded_image, design, lines, upload_encoding["image_format"],
+                                                          upload_encoding["compress_level"] or 6, upload_encoding["quality"])
+                track_upload(queue_upload(upload_bytes, metadata={"prompt": text, "size": f"{width}x{height}", "source": "text_editor"},
+                                          image_format=upload_encoding["image_format"]))
+                st.write("Image queued for upload to cloudflare")
+
+        size_variants(uploaded_image, (width, height), design)
+
+    display_upload_status()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,82 @@
+import datetime as dt
+
+import streamlit as st
+
+from tracing import get_tracer
+
+# Where this server process has spent its time, bytes and OpenAI budget since it started.
+# Spans are shared by every session, so this shows all users' activity, not just your own.
+
+SPEND_SPANS = ["refine_prompt", "generate_images_from_prompt", "generate_variations"]
+
+def display_stage_summary(tracer):
+    summary = tracer.summary()
+    if not summary:
+        st.write("Nothing has been traced yet")
+        return
+    rows = []
+    for name, values in sorted(summary.items()):
+        rows.append({
+            "stage": name, "count": values["count"], "errors": values["errors"], "total s": round(values["seconds"], 3),
+            "p50 ms": round(values["p50"] * 1000, 1) if values["p50"] is not None else None,
+            "p95 ms": round(values["p95"] * 1000, 1) if values["p95"] is not None else None,
+            "MB": round(values["bytes"] / 1e6, 2), "peak memory MB": round(values["peak_memory"] / 1e6, 1) or None,
+            "cost $": round(values["cost"], 4),
+        })
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+
+def display_spend(tracer):
+    # calc_costs' estimate shown to the user next to what was actually billed at list price
+    rows = []
+    for s in tracer.recent():
+        if s["name"] not in SPEND_SPANS:
+            continue
+        estimated, actual = s.get("estimated_cost"), s.get("actual_cost")
+        rows.append({
+            "time": dt.datetime.fromtimestamp(s["start"]).strftime("%H:%M:%S"), "call": s["name"], "model": s.get("model"),
+            "size": s.get("shape"), "requested": s.get("number"), "generated": s.get("generated"), "cached": s.get("cached"),
+            "failed": s.get("failed"), "estimated $": estimated, "actual $": actual,
+            "difference $": round(actual - estimated, 4) if estimated is not None and actual is not None else None,
+            "error": s["error"],
+        })
+    if not rows:
+        st.write("No OpenAI requests have been traced yet")
+        return
+    estimated_total = sum(row["estimated $"] or 0 for row in rows)
+    actual_total = sum(row["actual $"] or 0 for row in rows)
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Estimated spend", f"${estimated_total:.3f}")
+    c2.metric("Actual spend", f"${actual_total:.3f}")
+    c3.metric("Difference", f"${actual_total - estimated_total:+.3f}")
+    st.dataframe(list(reversed(rows)), use_container_width=True, hide_index=True)
+
+def main():
+    st.set_page_config(layout="wide")
+    st.title("Metrics")
+    tracer = get_tracer()
+
+    enabled = st.toggle("Tracing enabled", value=tracer.enabled, help="Applies to every session on this server")
+    if enabled != tracer.enabled:
+        tracer.enabled = enabled
+
+    st.subheader("Stages")
+    display_stage_summary(tracer)
+
+    st.subheader("OpenAI spend")
+    display_spend(tracer)
+
+    st.subheader("Recent spans")
+    name = st.selectbox("Stage", ["All"] + sorted(tracer.summary()))
+    spans = tracer.recent(None if name == "All" else name)[-200:]
+    st.dataframe(list(reversed(spans)), use_container_width=True, hide_index=True)
+
+    e1, e2, e3 = st.columns(3)
+    timestamp = dt.datetime.now().strftime("%Y%m%d-%H%M%S")
+    e1.download_button("Export spans as JSONL", tracer.to_jsonl(), file_name=f"spans-{timestamp}.jsonl", mime="application/jsonl")
+    e2.download_button("Export Prometheus metrics", tracer.to_prometheus(), file_name=f"metrics-{timestamp}.prom", mime="text/plain")
+    if e3.button("Clear"):
+        tracer.clear()
+        st.rerun()
+
+if __name__ == '__main__':
+    main()
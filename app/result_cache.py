@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# On-disk cache of OpenAI results shared across sessions and users: prompt refinements keyed on
+# (model, prompt, base instruction), and generated images. Images are stored under the hash of their
+# bytes, with an "image_request" entry pointing (model, prompt, size, variant) at the latest one, so a
+# cache:// URL always shows the same picture even after its request is generated again.
+
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "result_cache.sqlite3"))
+RESULT_CACHE_TTL = 7 * 24 * 60 * 60
+RESULT_CACHE_BYTES = 512 * 1024 * 1024
+
+# Cached images are addressed by this pseudo URL so they flow through the same paths as downloads
+CACHE_URL_PREFIX = "cache://"
+
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+class ResultCache:
+    def __init__(self, path=RESULT_CACHE_PATH, ttl=RESULT_CACHE_TTL, max_bytes=RESULT_CACHE_BYTES, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        with self._connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS results (
+                kind TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, bytes INTEGER NOT NULL,
+                created REAL NOT NULL, used REAL NOT NULL, PRIMARY KEY (kind, key))""")
+            db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, kind, key, count=True, load=True):
+        # load=False only checks for a live entry, without reading the value
+        now = self.clock()
+        with self.lock, self._connect() as db:
+            column = "value" if load else "NULL"
+            row = db.execute(f"SELECT {column}, created FROM results WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                db.execute("DELETE FROM results WHERE kind = ? AND key = ?", (kind, key))
+                row = None
+            if row is not None:
+                db.execute("UPDATE results SET used = ? WHERE kind = ? AND key = ?", (now, kind, key))
+            if count:
+                counter = self.misses if row is None else self.hits
+                counter[kind] = counter.get(kind, 0) + 1
+        if row is None:
+            return None
+        return row[0] if load else True
+
+    def put(self, kind, key, value):
+        now = self.clock()
+        with self.lock, self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", (kind, key, value, len(value), now, now))
+            self._evict(db, now)
+
+    def _evict(self, db, now):
+        # Drop expired entries, then the least recently used until the cache fits its size budget
+        db.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,))
+        total = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for kind, key, size in db.execute("SELECT kind, key, bytes FROM results ORDER BY used").fetchall():
+            db.execute("DELETE FROM results WHERE kind = ? AND key = ?", (kind, key))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def put_image(self, request_key, data):
+        # Stores a generated image and points its request at it, returning the digest it is cached under
+        digest = hashlib.sha256(data).hexdigest()
+        self.put("image", digest, data)
+        self.put("image_request", request_key, digest.encode())
+        return digest
+
+    def image_digest(self, request_key):
+        # Digest of the image last generated for this request, or None when there is none still cached.
+        # Counted as an image hit or miss.
+        digest = self.get("image_request", request_key, count=False)
+        if digest is None:
+            with self.lock:
+                self.misses["image"] = self.misses.get("image", 0) + 1
+            return None
+        digest = digest.decode()
+        return digest if self.get("image", digest, load=False) else None
+
+    def stats(self):
+        with self.lock, self._connect() as db:
+            entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM results").fetchone()
+        return {"hits": dict(self.hits), "misses": dict(self.misses), "entries": entries, "bytes": size}
+
+    def get_text(self, kind, key):
+        value = self.get(kind, key)
+        return value.decode() if value is not None else None
+
+    def put_text(self, kind, key, text):
+        self.put(kind, key, text.encode())
+
+_cache_lock = threading.Lock()
+_result_cache = None
+
+def get_result_cache():
+    global _result_cache
+    with _cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache()
+        return _result_cache
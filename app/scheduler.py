@@ -0,0 +1,181 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from functools import lru_cache
+
+# Client-side pacing for OpenAI calls shared by every session and batch job in the process.
+# Each model has a token bucket sized to our usage tier; callers queue per model by priority and
+# retryable failures are retried with exponential backoff, honouring Retry-After when OpenAI sends it.
+# Buckets and queues only exist within one process, so priority only orders calls inside it. batch.py
+# runs as its own process: it cannot let Streamlit users go first, so it paces itself to
+# BATCH_LIMIT_SHARE of the tier and leaves the rest to the app, which still assumes the whole tier.
+
+INTERACTIVE = 0
+BATCH = 1
+
+# Requests per minute and burst size for each model at our usage tier; adjust when the tier changes
+MODEL_LIMITS = {
+    "gpt-3.5-turbo-0125": (500, 20),
+    "dall-e-2": (50, 5),
+    "dall-e-3": (15, 3),
+}
+DEFAULT_LIMIT = (20, 2)
+
+# Share of each model's limits a separate batch process uses, see batch_limits
+BATCH_LIMIT_SHARE = 0.5
+
+MAX_RETRIES = 5
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+def batch_limits(share=BATCH_LIMIT_SHARE):
+    # MODEL_LIMITS scaled down for a process that shares the tier with the app
+    return {model: (per_minute * share, max(1, int(burst * share))) for model, (per_minute, burst) in MODEL_LIMITS.items()}
+
+@lru_cache(maxsize=1)
+def retryable_errors():
+    # openai is imported on first use rather than with this module, keeping it off the page's startup path
+    import openai
+    return (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+class Clock:
+    # Real time; tests pass a fake with the same two methods
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity, clock):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.clock = clock
+        self.updated = clock.time()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = self.clock.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def delay(self):
+        # Seconds until a token can be taken, 0 if one is available now
+        now = self._refill()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1 - 1e-9:  # Tolerate float error from the refill arithmetic
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        # After a 429 nobody sends to this model until the server's retry window has passed
+        self.paused_until = max(self.paused_until, self.clock.time() + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+def retry_after(error):
+    # Seconds the server asked us to wait, if it said
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+class RequestScheduler:
+    def __init__(self, limits=None, clock=None, max_retries=MAX_RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        self.limits = {**MODEL_LIMITS, **(limits or {})}
+        self.clock = clock or Clock()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.buckets = {}
+        self.queues = {}
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def _bucket(self, model):
+        if model not in self.buckets:
+            self.buckets[model] = TokenBucket(*self.limits.get(model, DEFAULT_LIMIT), self.clock)
+            self.queues[model] = []
+        return self.buckets[model]
+
+    def ticket(self, priority=INTERACTIVE):
+        # Lower priority values go first, then first come first served
+        return (priority, next(self.counter))
+
+    def acquire(self, model, ticket):
+        # Wait until this ticket is first in the model's queue and a token is available
+        with self.condition:
+            bucket = self._bucket(model)
+            queue = self.queues[model]
+            heapq.heappush(queue, ticket)
+        while True:
+            with self.condition:
+                if queue[0] == ticket:
+                    delay = bucket.delay()
+                    if delay <= 0:
+                        bucket.take()
+                        heapq.heappop(queue)
+                        self.condition.notify_all()
+                        return
+                else:
+                    self.condition.wait(timeout=1.0)
+                    continue
+            self.clock.sleep(delay)
+
+    def call(self, model, fn, /, *args, priority=INTERACTIVE, **kwargs):
+        # model and fn are positional-only so fn can itself take a model= keyword
+        # Retries keep their original ticket so they are not sent to the back of the queue
+        ticket = self.ticket(priority)
+        attempt = 0
+        while True:
+            self.acquire(model, ticket)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                import openai  # Already loaded by the client that raised
+                if not isinstance(e, retryable_errors()) or attempt >= self.max_retries:
+                    raise
+                wait = retry_after(e)
+                if wait is None:
+                    wait = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+                print(f"{e.__class__.__name__} from {model}, retrying in {wait:.1f}s (attempt {attempt + 1} of {self.max_retries})")
+                if isinstance(e, openai.RateLimitError):
+                    # Hold back every caller for this model, the retry then waits in acquire like the rest
+                    with self.condition:
+                        self.buckets[model].pause(wait)
+                else:
+                    self.clock.sleep(wait)
+                attempt += 1
+
+_scheduler_lock = threading.Lock()
+_scheduler = None
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+def configure_scheduler(limits=None):
+    # Replace the process' scheduler with one paced to these limits, before any calls are made
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = RequestScheduler(limits)
+        return _scheduler
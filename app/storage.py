@@ -0,0 +1,397 @@
+import datetime as dt
+import hashlib
+import itertools
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO
+
+import streamlit as st
+from PIL import Image
+
+from imaging import IMAGE_FORMATS, encode_image, make_thumbnail
+from result_cache import CACHE_URL_PREFIX, get_result_cache
+from tracing import span
+
+# boto3, dataplane and requests are imported where they are used, so pages that never upload or
+# download (the text editor, until it saves) start without them.
+
+# Background upload settings: worker threads, how many uploads may wait, and the retry policy
+UPLOAD_WORKERS = 2
+UPLOAD_QUEUE_SIZE = 64
+UPLOAD_RETRIES = 3
+UPLOAD_BACKOFF = 0.5
+
+# How images are encoded for R2: PNG at a zlib level, where None uploads PNGs exactly as they were
+# downloaded, or WebP at a quality, where 100 is lossless
+DEFAULT_UPLOAD_ENCODING = {"image_format": "PNG", "compress_level": None, "quality": 90}
+
+# Local index of everything uploaded, keyed on content hash
+IMAGE_INDEX_PATH = os.environ.get("IMAGE_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "image_index.sqlite3"))
+
+# Memory budget for the full resolution PNGs each session keeps; grid thumbnails are kept outside it
+IMAGE_STORE_BYTES = 128 * 1024 * 1024
+
+def get_secret(name):
+    # Environment variables take precedence so headless runs do not need a secrets.toml
+    if name in os.environ:
+        return os.environ[name]
+    return st.secrets[name]
+
+_client_lock = threading.Lock()
+
+def get_s3_client():
+    # One client per process so its connection pool is reused; creating clients is not thread safe so it is locked
+    with _client_lock:
+        return _build_s3_client()
+
+@lru_cache(maxsize=1)
+def _build_s3_client():
+    import boto3
+    from botocore.client import Config
+    return boto3.client(
+        's3',
+        endpoint_url=get_secret('CLOUDFLARE_CONNECTION_URL'),
+        aws_access_key_id=get_secret('CLOUDFLARE_API_KEY'),
+        aws_secret_access_key=get_secret('CLOUDFLARE_API_SECRET'),
+        config=Config(signature_version='s3v4', max_pool_connections=UPLOAD_WORKERS * 2),
+    )
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def content_key(digest, image_format="PNG"):
+    # Objects are named by their content, so identical images share a key and never collide
+    return f"generated_images/{digest[:2]}/{digest}.{IMAGE_FORMATS[image_format][0]}"
+
+class ImageIndex:
+    # SQLite index mapping content hashes to uploaded object keys and the generation metadata
+    def __init__(self, path=IMAGE_INDEX_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        with self._connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS images (
+                hash TEXT PRIMARY KEY, key TEXT NOT NULL, prompt TEXT, model TEXT, size TEXT,
+                source TEXT, bytes INTEGER, created TEXT NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS images_created ON images (created)")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def lookup(self, digest):
+        with self.lock, self._connect() as db:
+            row = db.execute("SELECT * FROM images WHERE hash = ?", (digest,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def record(self, digest, key, size_bytes, metadata=None):
+        metadata = metadata or {}
+        with self.lock, self._connect() as db:
+            db.execute("INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (digest, key, metadata.get("prompt"), metadata.get("model"), metadata.get("size"),
+                        metadata.get("source"), size_bytes, dt.datetime.now().isoformat(timespec="seconds")))
+
+    def search(self, text=None, model=None, limit=50):
+        # Newest first, optionally filtered by a prompt substring and model
+        query, params = "SELECT * FROM images WHERE 1 = 1", []
+        if text:
+            query += " AND prompt LIKE ?"
+            params.append(f"%{text}%")
+        if model:
+            query += " AND model = ?"
+            params.append(model)
+        query += " ORDER BY created DESC LIMIT ?"
+        params.append(limit)
+        with self.lock, self._connect() as db:
+            return [dict(row) for row in db.execute(query, params)]
+
+_index_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def _open_image_index():
+    return ImageIndex()
+
+def get_image_index():
+    with _index_lock:
+        return _open_image_index()
+
+def upload_image_to_cloudflare(image_bytes_array, key=None, client=None, bucket=None):
+    # Synchronous upload; most callers should use queue_upload instead
+    from dataplane import s3_upload
+    try:
+        # Upload the file
+        with span("upload_image_to_cloudflare", bytes=len(image_bytes_array)):
+            response = s3_upload(Bucket=bucket or get_secret('CLOUDFLARE_BUCKET'),
+                S3Client=client or get_s3_client(),
+                TargetFilePath=key or content_key(content_hash(image_bytes_array)),
+                UploadObject=image_bytes_array,
+                UploadMethod=""
+            )
+        return response
+    except FileNotFoundError:
+        print("The file was not found")
+        return None
+
+class UploadJob:
+    # Status of one queued upload: queued -> uploading -> (retrying ->) done or failed,
+    # or duplicate when the same bytes were already uploaded
+    _ids = itertools.count(1)
+
+    def __init__(self, digest, key, data, metadata=None):
+        self.id = next(self._ids)
+        self.digest = digest
+        self.key = key
+        self.data = data
+        self.size = len(data)
+        self.metadata = metadata or {}
+        self.status = "queued"
+        self.attempts = 0
+        self.error = None
+        self.finished = threading.Event()
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+class UploadQueue:
+    # Bounded queue drained by background workers, so uploads never block the page that requested them
+    def __init__(self, client_factory=get_s3_client, bucket=None, workers=UPLOAD_WORKERS, maxsize=UPLOAD_QUEUE_SIZE,
+                 retries=UPLOAD_RETRIES, backoff=UPLOAD_BACKOFF, sleep=time.sleep, index=None):
+        self.client_factory = client_factory
+        self.bucket = bucket
+        self.index = index
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.jobs = queue.Queue(maxsize=maxsize)
+        self.threads = [threading.Thread(target=self._work, daemon=True, name=f"upload-{n}") for n in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, data, key=None, metadata=None, image_format="PNG"):
+        digest = content_hash(data)
+        job = UploadJob(digest, key or content_key(digest, image_format), data, metadata)
+
+        # Bytes that are already in the bucket, or already on their way, skip the network entirely
+        existing = self.index.lookup(digest) if self.index is not None else None
+        if existing is not None:
+            job.key = existing["key"]
+            job.data = None
+            job.status = "duplicate"
+            job.finished.set()
+            return job
+        with self.pending_lock:
+            if digest in self.pending:
+                return self.pending[digest]
+            self.pending[digest] = job
+
+        # Blocks only when the queue is full, which applies back-pressure rather than dropping uploads
+        self.jobs.put(job)
+        return job
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                self._upload(job)
+            finally:
+                self.jobs.task_done()
+
+    def _upload(self, job):
+        while True:
+            job.attempts += 1
+            job.status = "uploading"
+            try:
+                upload_image_to_cloudflare(job.data, key=job.key, client=self.client_factory(),
+                                           bucket=self.bucket or get_secret('CLOUDFLARE_BUCKET'))
+                if self.index is not None:
+                    self.index.record(job.digest, job.key, job.size, job.metadata)
+                job.status = "done"
+                break
+            except Exception as e:
+                job.error = str(e)
+                if job.attempts > self.retries:
+                    print(f"Failed to upload {job.key} after {job.attempts} attempts: {e}")
+                    job.status = "failed"
+                    break
+                # Exponential backoff with jitter so parallel retries do not hit R2 together
+                job.status = "retrying"
+                self.sleep(self.backoff * 2 ** (job.attempts - 1) * random.uniform(0.5, 1.5))
+
+        job.data = None  # Release the image bytes once the upload has finished
+        with self.pending_lock:
+            self.pending.pop(job.digest, None)
+        job.finished.set()
+
+    def join(self):
+        self.jobs.join()
+
+_queue_lock = threading.Lock()
+_upload_queue = None
+
+def get_upload_queue():
+    # Shared by every session in the process, started on first use
+    global _upload_queue
+    with _queue_lock:
+        if _upload_queue is None:
+            _upload_queue = UploadQueue(index=get_image_index())
+        return _upload_queue
+
+def queue_upload(image_bytes_array, key=None, metadata=None, image_format="PNG"):
+    return get_upload_queue().submit(image_bytes_array, key, metadata, image_format)
+
+def track_upload(job):
+    # Remember the job in the user's session so its status can be shown
+    st.session_state.setdefault("upload_jobs", []).append(job)
+
+def select_upload_encoding():
+    # Sidebar choice of upload format, kept outside widget state so both pages share it
+    encoding = st.session_state.setdefault("upload_encoding", dict(DEFAULT_UPLOAD_ENCODING))
+    with st.sidebar.expander("Upload format"):
+        image_format = st.radio("Format", ["PNG", "WebP"], index=["PNG", "WebP"].index(encoding["image_format"]),
+                                horizontal=True, key="upload_image_format")
+        if image_format == "PNG":
+            level = st.select_slider("PNG compression", ["Original"] + list(range(1, 10)), value=encoding["compress_level"] or "Original",
+                                     key="upload_compress_level",
+                                     help="1 encodes fastest, 9 gives the smallest files. Original uploads generated images as OpenAI served them.")
+            encoding["compress_level"] = None if level == "Original" else level
+        else:
+            encoding["quality"] = st.slider("WebP quality", 50, 100, encoding["quality"], key="upload_quality",
+                                            help="Lossy WebP is a fraction of the size of PNG, 100 is lossless.")
+        encoding["image_format"] = image_format
+    return dict(encoding)
+
+def display_upload_status():
+    jobs = st.session_state.get("upload_jobs", [])
+    if not jobs:
+        return
+    with st.sidebar.expander(f"Cloudflare uploads ({sum(job.status in ('done', 'duplicate') for job in jobs)}/{len(jobs)} done)"):
+        for job in reversed(jobs[-20:]):
+            line = f"`{job.key}` {job.status}"
+            if job.attempts > 1:
+                line += f" after {job.attempts} attempts"
+            if job.status == "failed":
+                line += f": {job.error}"
+            st.markdown(line)
+
+def fetch_image_bytes(url):
+    if url.startswith(CACHE_URL_PREFIX):
+        with span("download", source="cache") as s:
+            data = get_result_cache().get("image", url[len(CACHE_URL_PREFIX):], count=False)
+            if data is None:
+                raise KeyError(f"{url} is no longer in the result cache")
+            s.set(bytes=len(data))
+        return data
+    import requests
+    with span("download", source="openai") as s:
+        response = requests.get(url, timeout=60)
+        response.raise_for_status()
+        s.set(bytes=len(response.content))
+    return response.content
+
+class StoredImage:
+    # One downloaded image: RGB PNG bytes for uploads and downloads, and a small WebP thumbnail for grids,
+    # made once when the image is stored. The decoded image is not kept; only other upload encodings need
+    # it, and they decode the PNG again.
+    def __init__(self, url, data):
+        image = Image.open(BytesIO(data))
+        image_format = image.format
+        self.url = url
+        if image_format != "PNG" or image.mode != "RGB":
+            image = image.convert("RGB")
+            data = encode_image(image)
+        # DALL-E already serves RGB PNGs, so the download is usually kept as is
+        self.png = data
+        self.thumbnail = make_thumbnail(image)
+        self.size = len(self.png)
+
+    def encoded(self, image_format="PNG", compress_level=None, quality=90):
+        # Bytes in the requested upload encoding, see DEFAULT_UPLOAD_ENCODING
+        if image_format == "PNG" and compress_level is None:
+            return self.png
+        return encode_image(Image.open(BytesIO(self.png)), image_format, compress_level or 6, quality)
+
+class ImageStore:
+    # Per-session store of downloaded images. The PNGs are kept in an LRU bounded by their bytes, the
+    # thumbnails for as long as the session, so drawing a grid never downloads anything again, even
+    # once the PNG is evicted or the (expiring) URL is gone. Each URL is downloaded once while it is stored.
+    def __init__(self, max_bytes=IMAGE_STORE_BYTES, fetch=fetch_image_bytes):
+        self.max_bytes = max_bytes
+        self.fetch = fetch
+        self.entries = OrderedDict()
+        self.thumbnails = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def peek(self, url):
+        # The stored image, or None if it is not held, without downloading it
+        with self.lock:
+            return self.entries.get(url)
+
+    def thumbnail(self, url):
+        # The grid thumbnail. Only a URL the store has never held is downloaded, and only once, even if that fails.
+        with self.lock:
+            if url in self.thumbnails:
+                return self.thumbnails[url]
+        entry = self.get(url)
+        if entry is None:
+            with self.lock:
+                self.thumbnails.setdefault(url, None)
+        return entry.thumbnail if entry else None
+
+    def get(self, url):
+        # Returns the stored image, downloading it on first use, or None if it cannot be fetched
+        with self.lock:
+            if url in self.entries:
+                self.entries.move_to_end(url)
+                return self.entries[url]
+        try:
+            return self.put(url, self.fetch(url))
+        except Exception as e:
+            print(f"Failed to load image: URL has expired or is not an image: {url} ({e})")
+            return None
+
+    def put(self, url, data):
+        with span("store_image", track_memory=True, bytes=len(data)):  # Decode and thumbnail
+            entry = StoredImage(url, data)
+        with self.lock:
+            if url in self.entries:
+                self.total_bytes -= self.entries.pop(url).size
+            self.entries[url] = entry
+            self.thumbnails[url] = entry.thumbnail
+            self.total_bytes += entry.size
+            # Evict the least recently used PNGs, always keeping the newest one; their thumbnails stay
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+        return entry
+
+def get_image_store():
+    # Created on the script thread; worker threads are handed the store explicitly
+    if "image_store" not in st.session_state:
+        st.session_state["image_store"] = ImageStore()
+    return st.session_state["image_store"]
+
+def display_image_search():
+    # Search past uploads through the local index rather than listing the bucket
+    with st.sidebar.expander("Search past generations"):
+        text = st.text_input("Prompt contains", key="image_search_text")
+        model = st.selectbox("Model", ["Any", "dall-e-2", "dall-e-3"], key="image_search_model")
+        if text or model != "Any":
+            results = get_image_index().search(text, None if model == "Any" else model, limit=20)
+            if not results:
+                st.write("No matching images")
+            for row in results:
+                st.markdown(f"`{row['key']}` {row['created']} {row['model'] or row['source'] or ''} {row['size'] or ''}")
+                if row["prompt"]:
+                    st.caption(row["prompt"])
@@ -0,0 +1,226 @@
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Lightweight tracing of where a request's time, bytes and money go. Code wraps each stage in
+#
+#   with span("download", url=url) as s:
+#       ...
+#       s.set(bytes=len(data))
+#
+# Finished spans are kept in a bounded in-memory buffer, with running totals per span name, for the
+# Metrics page and the JSONL and Prometheus exports. Spans on the same thread nest under each other.
+# Set TRACING=0 to disable; span() then returns a shared no-op object, so the cost is one attribute check.
+# Set TRACE_LOG to a path to also append every span to that file as JSONL, e.g. for batch runs.
+# span(name, track_memory=True) also records peak_memory: how far the process' resident memory rose
+# above where it was when the span started. Pillow allocates pixels outside Python's allocator, so
+# this is read from the kernel rather than tracemalloc, and is only available on Linux. Where the
+# peak mark cannot be read or reset, peak_memory is recorded as None rather than a stale peak.
+
+TRACE_BUFFER_SIZE = 5000
+
+def resident_memory():
+    # (current, peak) resident set size of this process in bytes, or None where /proc is unavailable
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["VmRSS"].split()[0]) * 1024, int(fields["VmHWM"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+def reset_peak_memory():
+    # Lower the kernel's peak resident size mark to the current size (Linux 4.0+). Returns whether it was
+    # reset; if not, the mark is still the peak over the process' whole life.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+class Span:
+    __slots__ = ("tracer", "id", "parent", "name", "attrs", "start", "wall_start", "duration", "error", "thread", "memory_start")
+
+    def __init__(self, tracer, name, attrs, track_memory=False):
+        self.tracer = tracer
+        self.id = next(tracer.ids)
+        self.name = name
+        self.attrs = attrs
+        self.error = None
+        self.duration = None
+        self.memory_start = track_memory
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def add(self, name, amount):
+        # Accumulate a numeric attribute, e.g. bytes moved over several reads
+        self.attrs[name] = self.attrs.get(name, 0) + amount
+        return self
+
+    def fail(self, error):
+        # Mark the span failed for an error that was handled rather than raised through it
+        self.error = f"{error.__class__.__name__}: {error}"
+        return self
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.parent = stack[-1].id if stack else None
+        stack.append(self)
+        self.thread = threading.current_thread().name
+        if self.memory_start:
+            self.memory_start = self.tracer.memory_enter()
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if self.memory_start is not False:
+            self.tracer.memory_exit(self)
+        if exc is not None and self.error is None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        stack = self.tracer.stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        self.tracer.finish(self)
+        return False
+
+    def to_dict(self):
+        return {"id": self.id, "parent": self.parent, "name": self.name, "start": self.wall_start, "duration": self.duration,
+                "thread": self.thread, "error": self.error, **self.attrs}
+
+class NullSpan:
+    # Stands in for a span while tracing is disabled
+    __slots__ = ()
+
+    def set(self, **attrs):
+        return self
+
+    def add(self, name, amount):
+        return self
+
+    def fail(self, error):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Tracer:
+    def __init__(self, enabled=True, buffer_size=TRACE_BUFFER_SIZE, log_path=None):
+        self.enabled = enabled
+        self.spans = deque(maxlen=buffer_size)
+        self.totals = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.log_path = log_path
+        self.memory_spans = 0
+        self.memory_reset = False
+
+    def span(self, name, track_memory=False, **attrs):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attrs, track_memory)
+
+    def memory_enter(self):
+        # The peak mark is process wide, so it is only reset while no other span is tracking memory.
+        # Overlapping spans then read a peak taken over a window that contains their own, an upper bound.
+        with self.lock:
+            if self.memory_spans == 0:
+                self.memory_reset = reset_peak_memory()
+            self.memory_spans += 1
+            reset = self.memory_reset
+        usage = resident_memory()
+        return usage[0] if usage and reset else None
+
+    def memory_exit(self, span):
+        with self.lock:
+            self.memory_spans -= 1
+        usage = resident_memory() if span.memory_start is not None else None
+        span.attrs["peak_memory"] = max(0, usage[1] - span.memory_start) if usage else None
+
+    def stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def finish(self, span):
+        record = span.to_dict()
+        with self.lock:
+            self.spans.append(record)
+            # Totals cover every span since start, not just those still in the buffer
+            totals = self.totals.setdefault(span.name, {"count": 0, "errors": 0, "seconds": 0.0, "bytes": 0, "cost": 0.0, "peak_memory": 0})
+            totals["count"] += 1
+            totals["errors"] += span.error is not None
+            totals["seconds"] += span.duration
+            totals["bytes"] += span.attrs.get("bytes", 0) or 0
+            totals["cost"] += span.attrs.get("cost", 0.0) or 0.0
+            totals["peak_memory"] = max(totals["peak_memory"], span.attrs.get("peak_memory", 0) or 0)
+            if self.log_path:
+                with open(self.log_path, "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+    def recent(self, name=None):
+        with self.lock:
+            spans = list(self.spans)
+        return [s for s in spans if name is None or s["name"] == name]
+
+    def summary(self):
+        # Running totals per span name, with latency percentiles from the spans still buffered
+        with self.lock:
+            totals = {name: dict(values) for name, values in self.totals.items()}
+            spans = list(self.spans)
+        durations = {}
+        for s in spans:
+            durations.setdefault(s["name"], []).append(s["duration"])
+        for name, values in totals.items():
+            times = sorted(durations.get(name, []))
+            values["p50"] = times[len(times) // 2] if times else None
+            values["p95"] = times[min(len(times) - 1, int(len(times) * 0.95))] if times else None
+        return totals
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+            self.totals.clear()
+
+    def to_jsonl(self):
+        return "".join(json.dumps(s, default=str) + "\n" for s in self.recent())
+
+    def to_prometheus(self, prefix="sketchbook"):
+        # Prometheus text exposition format for the running totals
+        summary = self.summary()
+        metrics = [
+            ("span_seconds_total", "counter", "Seconds spent in each traced stage", "seconds"),
+            ("span_count_total", "counter", "Number of times each traced stage ran", "count"),
+            ("span_errors_total", "counter", "Number of traced stages that failed", "errors"),
+            ("span_bytes_total", "counter", "Bytes moved by each traced stage", "bytes"),
+            ("span_cost_dollars_total", "counter", "OpenAI spend attributed to each traced stage", "cost"),
+            ("span_peak_memory_bytes", "gauge", "Largest rise in resident memory during each traced stage", "peak_memory"),
+        ]
+        lines = []
+        for metric, metric_type, description, field in metrics:
+            lines.append(f"# HELP {prefix}_{metric} {description}")
+            lines.append(f"# TYPE {prefix}_{metric} {metric_type}")
+            for name, values in sorted(summary.items()):
+                lines.append(f'{prefix}_{metric}{{span="{name}"}} {values[field]}')
+        return "\n".join(lines) + "\n"
+
+_tracer = Tracer(enabled=os.environ.get("TRACING", "1") != "0", log_path=os.environ.get("TRACE_LOG"))
+
+def get_tracer():
+    return _tracer
+
+def span(name, track_memory=False, **attrs):
+    return _tracer.span(name, track_memory, **attrs)
@@ -0,0 +1,167 @@
+# End to end timing of generate -> download -> upload against local stand-ins for OpenAI and R2,
+# so it runs offline. Run from the repository root:
+#
+#   python benchmarks/e2e.py --images 4 --size 1792x1024 --format WebP
+#   python benchmarks/e2e.py --save benchmarks/baselines/e2e-local.json
+#
+# --latency adds a delay to every stub OpenAI response to imitate the real API.
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The caches, index and R2 settings are read when the app modules are imported, so point them at a scratch directory first
+SCRATCH_DIR = tempfile.mkdtemp(prefix="e2e-benchmark-")
+os.environ.update({
+    "RESULT_CACHE_PATH": os.path.join(SCRATCH_DIR, "result_cache.sqlite3"),
+    "IMAGE_INDEX_PATH": os.path.join(SCRATCH_DIR, "image_index.sqlite3"),
+    "CLOUDFLARE_API_KEY": "benchmark",
+    "CLOUDFLARE_API_SECRET": "benchmark",
+    "CLOUDFLARE_BUCKET": "benchmark",
+})
+
+from openai import OpenAI
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+import scheduler
+from generation import generate_images_from_prompt
+from imaging import encode_image
+from scheduler import MODEL_LIMITS, RequestScheduler
+from storage import DEFAULT_UPLOAD_ENCODING, ImageStore, fetch_image_bytes
+from suite import add_arguments, photo_like, report
+
+class OpenAIStub(BaseHTTPRequestHandler):
+    # Chat completions echo the prompt; image generations return a URL on this server for the next prepared PNG
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])) or b"{}")
+        time.sleep(self.server.latency)
+        if self.path.endswith("/chat/completions"):
+            message = {"role": "assistant", "content": request["messages"][0]["content"]}
+            body = {"id": "stub", "object": "chat.completion", "created": 0, "model": request["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": message}]}
+        else:
+            with self.server.lock:
+                n = self.server.served
+                self.server.served += 1
+            body = {"created": 0, "data": [{"url": f"http://127.0.0.1:{self.server.server_port}/images/{n}.png"}]}
+        self._send(json.dumps(body).encode(), "application/json")
+
+    def do_GET(self):
+        n = int(self.path.rsplit("/", 1)[-1].split(".")[0])
+        self._send(self.server.images[n % len(self.server.images)], "image/png")
+
+class S3Stub(BaseHTTPRequestHandler):
+    # Accepts single part PutObject requests, which is all upload_fileobj sends for images under its 8MB multipart threshold
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            self.server.objects[self.path] = len(body)
+        self.send_response(200)
+        self.send_header("ETag", '"{}"'.format(hashlib.md5(body).hexdigest()))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+def start_server(handler, **attributes):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.lock = threading.Lock()
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def distinct_images(size, count):
+    # Every generation gets different pixels so the content hash dedupe does not skip its upload
+    base = photo_like(size)
+    def variant(n):
+        image = base.copy()
+        image.paste((n * 37 % 256, n * 91 % 256, n * 53 % 256), (0, 0, 32, 32))
+        return encode_image(image, compress_level=1)
+    with ThreadPoolExecutor() as pool:
+        return list(pool.map(variant, range(count)))
+
+def run_round(client, prompt, images, model, size, encoding):
+    # One user action: generate, download and queue uploads, then wait for the uploads to drain
+    download_time = [0.0]
+    def timed_fetch(url):
+        start = time.perf_counter()
+        data = fetch_image_bytes(url)
+        download_time[0] += time.perf_counter() - start
+        return data
+    store = ImageStore(fetch=timed_fetch)
+    jobs = []
+    start = time.perf_counter()
+    urls = generate_images_from_prompt(client, prompt, number=images, model=model, shape=size, _store=store, force=True,
+                                       encoding=encoding, on_image=lambda i, url, job: jobs.append(job))
+    generated = time.perf_counter()
+    for job in jobs:
+        job.wait()
+    finished = time.perf_counter()
+    if len(urls) != images or any(job is None or job.status != "done" for job in jobs):
+        raise RuntimeError(f"round failed: {len(urls)} of {images} images, uploads {[job and job.status for job in jobs]}")
+    return {"generate": generated - start, "download": download_time[0], "upload": finished - generated, "total": finished - start}
+
+def main():
+    parser = argparse.ArgumentParser(description="Time generate -> download -> upload against local stub servers")
+    parser.add_argument("--images", type=int, default=4, help="images per round")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--size", default="1792x1024")
+    parser.add_argument("--model", default="dall-e-3")
+    parser.add_argument("--format", default="PNG", choices=["PNG", "WebP"], help="upload encoding")
+    parser.add_argument("--compress-level", type=int, default=None, help="PNG level, by default PNGs are uploaded as downloaded")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each stub OpenAI response")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    size = tuple(int(n) for n in args.size.split("x"))
+    print(f"Preparing {args.images * (args.rounds + 1)} {args.size} images in {SCRATCH_DIR}")
+    openai_stub = start_server(OpenAIStub, images=distinct_images(size, args.images * (args.rounds + 1)), served=0, latency=args.latency)
+    s3_stub = start_server(S3Stub, objects={})
+    os.environ["CLOUDFLARE_CONNECTION_URL"] = f"http://127.0.0.1:{s3_stub.server_port}"
+
+    # The stubs have no rate limits, so pace only as far as needed to keep every request concurrent
+    scheduler._scheduler = RequestScheduler(limits={model: (60000, 100) for model in MODEL_LIMITS})
+    client = OpenAI(api_key="benchmark", base_url=f"http://127.0.0.1:{openai_stub.server_port}/v1", max_retries=0)
+    encoding = {**DEFAULT_UPLOAD_ENCODING, "image_format": args.format, "compress_level": args.compress_level}
+
+    run_round(client, "warm up", args.images, args.model, args.size, encoding)
+    rounds = [run_round(client, f"round {n}", args.images, args.model, args.size, encoding) for n in range(args.rounds)]
+
+    name = f"e2e/{args.size}/{args.images}images/{args.format}" + (f"{args.compress_level}" if args.compress_level else "")
+    results = {}
+    for stage in ["generate", "download", "upload", "total"]:
+        times = [r[stage] for r in rounds]
+        results[f"{name}/{stage}"] = {"median": statistics.median(times), "min": min(times), "repeats": len(times)}
+        print(f"{name}/{stage:<10} {results[f'{name}/{stage}']['median'] * 1000:10.1f} ms")
+    uploaded = sum(s3_stub.objects.values())
+    print(f"{len(s3_stub.objects)} objects, {uploaded / 1e6:.1f} MB uploaded")
+    shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+    report(args, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Compare what showing and uploading a generated image costs in each encoding
+# Run from the repository root: python benchmarks/encoding.py
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from imaging import encode_image, make_thumbnail
+
+SIZES = [(1024, 1024), (1792, 1024)]
+
+# (label, encode_image arguments) for the upload encodings offered in the sidebar
+UPLOAD_ENCODINGS = [
+    ("PNG level 1", ("PNG", 1, 90)),
+    ("PNG level 6", ("PNG", 6, 90)),
+    ("PNG level 9", ("PNG", 9, 90)),
+    ("WebP q90", ("WebP", 6, 90)),
+    ("WebP lossless", ("WebP", 6, 100)),
+]
+
+def photo_like(size, seed=0):
+    # Smooth colour fields with fine grain, which compresses roughly like a DALL-E render
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray(rng.integers(0, 256, (size[1] // 64, size[0] // 64, 3), dtype=np.uint8))
+    smooth = np.asarray(coarse.resize(size, Image.BICUBIC), dtype=np.int16)
+    grain = rng.integers(-6, 7, smooth.shape, dtype=np.int16)
+    return Image.fromarray(np.clip(smooth + grain, 0, 255).astype(np.uint8))
+
+def timed(func, repeats=3):
+    best, result = float("inf"), None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    for size in SIZES:
+        image = photo_like(size)
+        print(f"{size[0]}x{size[1]}")
+
+        # The grid used to hand the full image to st.image, which encodes it as PNG on every rerun
+        full_time, full = timed(lambda: encode_image(image))
+        thumb_time, thumb = timed(lambda: make_thumbnail(image))
+        print(f"  grid image per rerun: full PNG {full_time * 1000:7.1f} ms {len(full) / 1e3:8.0f} kB, "
+              f"thumbnail once {thumb_time * 1000:6.1f} ms {len(thumb) / 1e3:6.0f} kB")
+
+        for label, arguments in UPLOAD_ENCODINGS:
+            encode_time, data = timed(lambda: encode_image(image, *arguments))
+            print(f"  upload {label:<14} {encode_time * 1000:7.1f} ms {len(data) / 1e3:8.0f} kB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# Compare the per-pixel gradient loop against the vectorised engine in app/imaging.py
+# Run from the repository root: python benchmarks/gradient.py
+import os
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from imaging import add_gradient
+
+SIZES = [(256, 256), (512, 512), (1024, 1024), (1792, 1024)]
+
+def legacy_add_gradient(image, gradient_type, gradient_offset=0):
+    # The original implementation from pages/Add_Text.py, kept for comparison
+    width, height = image.size
+    pixels = image.load()
+
+    if gradient_type == "Top":
+        for y in range(height - gradient_offset):
+            for x in range(width):
+                blend_factor = 1 - ((y) / (height - gradient_offset))
+                pixels[x, y] = tuple([int(c * (1-blend_factor)) for c in pixels[x, y][:3]])
+
+    elif gradient_type == "Bottom":
+        for y in range(gradient_offset, height):
+            for x in range(width):
+                blend_factor = (y - gradient_offset) / (height - gradient_offset)
+                pixels[x, y] = tuple([int(c * (1-blend_factor)) for c in pixels[x, y][:3]])
+
+    return image
+
+def time_per_megapixel(func, size, repeats):
+    image = Image.new("RGB", size, (200, 120, 60))
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func(image.copy(), "Bottom", size[1] // 2)
+    elapsed = (time.perf_counter() - start) / repeats
+    return elapsed * 1e6 / (size[0] * size[1])
+
+def main():
+    print(f"{'size':>10} {'legacy s/MP':>12} {'vectorised s/MP':>16} {'speedup':>8}")
+    for size in SIZES:
+        legacy = time_per_megapixel(legacy_add_gradient, size, repeats=1)
+        vectorised = time_per_megapixel(add_gradient, size, repeats=20)
+        print(f"{size[0]}x{size[1]:<5} {legacy:>12.4f} {vectorised:>16.5f} {legacy / vectorised:>7.0f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# One layout rendered to several output sizes: a single render_layout_sizes batch against a separate
+# render_layout call per size. Run from the repository root:
+#
+#   python benchmarks/layout.py
+#   python benchmarks/layout.py --glow --save benchmarks/baselines/layout-local.json
+#
+# "cold" clears the font and fitting caches before every repeat, as for a new design; "warm" keeps them,
+# as when the same design is rendered again.
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+import imaging
+from imaging import SIZE_PRESETS, default_layout, render_layout, render_layout_sizes
+from suite import add_arguments, measure, photo_like, report
+
+HEADLINE = "THIS IS SOME REALLY LONG TEXT FOR A HEADLINE THAT WRAPS OVER SEVERAL LINES"
+SUBHEADING = "And a subheading underneath it"
+
+def clear_caches():
+    imaging.load_font.cache_clear()
+    imaging._fit_text_box.cache_clear()
+
+def main():
+    parser = argparse.ArgumentParser(description="Time rendering one layout to many sizes")
+    parser.add_argument("--source", default="1792x1024", help="size of the generated image the layout is drawn on")
+    parser.add_argument("--glow", action="store_true", help="add a glow behind the headline, the most expensive effect")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    source = tuple(int(n) for n in args.source.split("x"))
+    image = photo_like(source)
+    layout = default_layout(HEADLINE, SUBHEADING)
+    if args.glow:
+        layout["boxes"][0]["glow_color"] = "#FFFF00"
+    sizes = list(SIZE_PRESETS.values())
+
+    def separate(_):
+        return [render_layout(image, layout, size) for size in sizes]
+
+    def batch(_):
+        return render_layout_sizes(image, layout, sizes)
+
+    results = {}
+    for cache, setup in [("warm", None), ("cold", clear_caches)]:
+        for name, func in [("separate", separate), ("batch", batch)]:
+            key = f"layout/{args.source}/{len(sizes)}sizes/{cache}/{name}"
+            results[key] = measure(func, setup, min_time=1.0)
+            print(f"{key:<48} {results[key]['median'] * 1000:10.1f} ms  (x{results[key]['repeats']})")
+    report(args, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Peak memory of decoding uploads, each case in a fresh interpreter so earlier cases do not hide its peak.
+# Run from the repository root:
+#
+#   python benchmarks/memory.py
+#   python benchmarks/memory.py --sizes 4032x3024 --save benchmarks/baselines/memory-local.json
+#
+# "variation" and "editor" are what the pages decode when an image is uploaded, "variants" and "export"
+# what the text editor decodes when size variants are rendered or the full resolution image is exported.
+# The "previous" cases are the decoding the pages did before uploads were decoded reduced, for comparison.
+# This only reports peaks; tests/test_imaging.py holds the upload paths to fixed limits.
+# Peaks come from the tracing spans' track_memory, so this needs Linux.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from suite import add_arguments, photo_like, report
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_DIR = os.path.join(ROOT_DIR, "app")
+
+PIPELINES = ["variation", "editor", "variants", "export", "previous_variation", "previous_editor"]
+
+# Runs in a fresh interpreter: decodes the file with the named pipeline and prints the span's peak memory
+CASE = """
+import json, sys
+from io import BytesIO
+from PIL import Image
+from imaging import MAX_EDIT_SIZE, load_image, variation_png
+from tracing import span
+
+def previous_variation(file):
+    image = Image.open(file)
+    with BytesIO() as buffer:
+        image.save(buffer, format="PNG")
+        buffer.seek(0)
+        image_png = Image.open(buffer)
+        image_png.load()
+        return buffer.getvalue()
+
+def previous_editor(file):
+    image = Image.open(file)
+    return image.convert("RGB")
+
+pipelines = {"variation": variation_png, "editor": lambda file: load_image(file, 800),  # The editor's 800 pixel preview
+             "variants": lambda file: load_image(file, MAX_EDIT_SIZE), "export": load_image,
+             "previous_variation": previous_variation, "previous_editor": previous_editor}
+with open(sys.argv[2], "rb") as f:
+    upload = BytesIO(f.read())  # Streamlit hands pages the whole upload in memory too
+with span("case", track_memory=True) as s:
+    result = pipelines[sys.argv[1]](upload)
+print(json.dumps({"peak_memory": s.attrs["peak_memory"]}))
+"""
+
+def run_case(pipeline, path):
+    process = subprocess.run([sys.executable, "-c", CASE, pipeline, path], capture_output=True, text=True,
+                             env={**os.environ, "PYTHONPATH": APP_DIR})
+    if process.returncode != 0:
+        raise RuntimeError(f"{pipeline} failed: {process.stderr.strip().splitlines()[-1]}")
+    return json.loads(process.stdout)["peak_memory"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the peak memory of decoding uploads")
+    parser.add_argument("--sizes", default="6000x4000,8064x6048", help="sizes of the photos being uploaded, 24 and 48 megapixels by default")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        for size_name in args.sizes.split(","):
+            size = tuple(int(n) for n in size_name.split("x"))
+            image = photo_like(size)
+            for file_format in ["JPEG", "PNG"]:
+                path = os.path.join(scratch, f"upload.{file_format.lower()}")
+                image.save(path, file_format, **({"quality": 90} if file_format == "JPEG" else {"compress_level": 1}))
+                for pipeline in PIPELINES:
+                    peak = run_case(pipeline, path)
+                    name = f"memory/{size_name}/{file_format}/{pipeline}"
+                    results[name] = {"median": peak, "min": peak, "repeats": 1}
+                    print(f"{name:<48} {peak / 1e6:8.1f} MB")
+            del image
+    report(args, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# Cold start timings: the first render of each page in a fresh interpreter, the Streamlit server
+# boot, and optionally the container boot. Run from the repository root:
+#
+#   python benchmarks/startup.py
+#   python benchmarks/startup.py --docker-image sketchbook       # also time `docker run` until healthy
+#   python benchmarks/startup.py --save benchmarks/baselines/startup-local.json
+#
+# Build the image first with `docker build -t sketchbook app`.
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from suite import add_arguments, report
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_DIR = os.path.join(ROOT_DIR, "app")
+PAGES = ["Generate.py", "pages/Add_Text.py", "pages/Metrics.py"]
+
+# Runs in a fresh interpreter: times importing Streamlit, then the page's first run, which imports everything it needs
+FIRST_RENDER = """
+import sys, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+at.secrets["OPENAI_API_KEY"] = at.secrets["OPENAI_ORG"] = "startup-benchmark"
+at.run()
+if at.exception:
+    raise SystemExit(at.exception[0].value)
+heavy = sorted(name for name in ("boto3", "dataplane", "openai", "numpy", "requests") if name in sys.modules)
+print(imported - start, time.perf_counter() - imported, ",".join(heavy))
+"""
+
+def first_render(page):
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, "-c", FIRST_RENDER, os.path.join(APP_DIR, page)], cwd=ROOT_DIR,
+                             capture_output=True, text=True, env={**os.environ, "PYTHONPATH": APP_DIR})
+    if process.returncode != 0:
+        raise RuntimeError(f"{page} failed to render: {process.stderr.strip().splitlines()[-1]}")
+    output = process.stdout.split()
+    return {"process": time.perf_counter() - started, "streamlit": float(output[0]), "render": float(output[1]),
+            "modules": output[2] if len(output) > 2 else ""}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_healthy(port, timeout=120):
+    # Seconds until Streamlit's health endpoint answers, the same check the Dockerfile's HEALTHCHECK makes
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter() - started
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"nothing healthy on port {port} after {timeout}s")
+
+def server_boot():
+    port = free_port()
+    process = subprocess.Popen([sys.executable, "-m", "streamlit", "run", "Generate.py", "--server.headless=true",
+                                f"--server.port={port}", "--server.address=127.0.0.1", "--browser.gatherUsageStats=false"],
+                               cwd=APP_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return wait_healthy(port)
+    finally:
+        process.terminate()
+        process.wait()
+
+def container_boot(image):
+    port = free_port()
+    container = subprocess.run(["docker", "run", "-d", "-p", f"127.0.0.1:{port}:8501", image], check=True,
+                               capture_output=True, text=True).stdout.strip()
+    try:
+        return wait_healthy(port)
+    finally:
+        subprocess.run(["docker", "rm", "-f", container], capture_output=True)
+
+def summarise(times):
+    return {"median": statistics.median(times), "min": min(times), "repeats": len(times)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Time cold starts of the Streamlit pages, server and container")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--docker-image", help="also time this image from `docker run` until it is healthy")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    results = {}
+    for page in PAGES:
+        try:
+            runs = [first_render(page) for _ in range(args.repeats)]
+        except RuntimeError as e:
+            print(e)
+            continue
+        for stage in ["process", "render"]:
+            results[f"startup/{page}/{stage}"] = summarise([run[stage] for run in runs])
+        print(f"{page:<20} first render {results[f'startup/{page}/render']['median'] * 1000:7.0f} ms, "
+              f"whole process {results[f'startup/{page}/process']['median'] * 1000:7.0f} ms, "
+              f"Streamlit import {statistics.median(run['streamlit'] for run in runs) * 1000:5.0f} ms, "
+              f"loaded: {runs[-1]['modules'] or 'none of the heavy modules'}")
+
+    results["startup/server_boot"] = summarise([server_boot() for _ in range(args.repeats)])
+    print(f"{'server boot':<20} {results['startup/server_boot']['median'] * 1000:7.0f} ms until healthy")
+
+    if args.docker_image:
+        results["startup/container_boot"] = summarise([container_boot(args.docker_image) for _ in range(args.repeats)])
+        print(f"{'container boot':<20} {results['startup/container_boot']['median'] * 1000:7.0f} ms until healthy")
+    report(args, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# Timings for the image processing hot paths at every DALL-E size, bundled font and outline width.
+# Run from the repository root:
+#
+#   python benchmarks/suite.py                                   # print timings
+#   python benchmarks/suite.py --save benchmarks/baselines/local.json
+#   python benchmarks/suite.py --compare benchmarks/baselines/local.json
+#
+# --compare exits with status 1 when a case is slower than the baseline by more than --threshold.
+# Baselines are only comparable on the same machine, so none are committed; record one locally with --save.
+# Everything runs offline on the CPU; e2e.py times the generate -> download -> upload path.
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+import PIL
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from imaging import (FONTS_DIR, add_gradient, add_text_to_image, draw_text_with_outline, encode_image, list_fonts, load_font,
+                     wrap_text)
+from storage import StoredImage
+
+# Every size the generation page offers
+SIZES = [(256, 256), (512, 512), (1024, 1024), (1792, 1024), (1024, 1792)]
+OUTLINE_WIDTHS = [2, 8, 16]
+GRADIENTS = ["Top", "Radial"]
+TEXT = "THIS IS SOME REALLY LONG TEXT FOR A HEADLINE THAT WRAPS OVER SEVERAL LINES"
+
+# Each case is timed until it has run for at least MIN_TIME seconds, between MIN_REPEATS and MAX_REPEATS times
+MIN_TIME = 0.2
+MIN_REPEATS = 3
+MAX_REPEATS = 200
+
+def photo_like(size, seed=0):
+    # Smooth colour fields with fine grain, which compresses roughly like a DALL-E render
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray(rng.integers(0, 256, (max(1, size[1] // 64), max(1, size[0] // 64), 3), dtype=np.uint8))
+    smooth = np.asarray(coarse.resize(size, Image.BICUBIC), dtype=np.int16)
+    grain = rng.integers(-6, 7, smooth.shape, dtype=np.int16)
+    return Image.fromarray(np.clip(smooth + grain, 0, 255).astype(np.uint8))
+
+def measure(func, setup=None, min_time=MIN_TIME):
+    # func(state) is timed on a fresh state from setup() each repeat, so in-place operations start equal
+    setup = setup or (lambda: None)
+    func(setup())  # Warm up caches such as loaded fonts and glyph metrics
+    times = []
+    while len(times) < MAX_REPEATS and (len(times) < MIN_REPEATS or sum(times) < min_time):
+        state = setup()
+        start = time.perf_counter()
+        func(state)
+        times.append(time.perf_counter() - start)
+    return {"median": statistics.median(times), "min": min(times), "repeats": len(times)}
+
+def size_name(size):
+    return f"{size[0]}x{size[1]}"
+
+def font_size_for(size):
+    # The editor's default font size is a tenth of the image width
+    return max(8, size[0] // 10)
+
+def cases():
+    # Yields (name, func, setup) for every case in the suite
+    fonts = list_fonts()
+    for size in SIZES:
+        base = photo_like(size)
+        name = size_name(size)
+
+        for gradient in GRADIENTS:
+            yield f"add_gradient/{name}/{gradient}", lambda image, g=gradient, offset=size[1] // 2: add_gradient(image, g, offset), base.copy
+
+        png = encode_image(base)
+        yield f"png_encode/{name}", lambda image: encode_image(image), lambda: base
+        yield f"png_decode/{name}", lambda data: Image.open(BytesIO(data)).load(), lambda: png
+        # What get_byte_array_from_url pays for each new download: decode, thumbnail and the PNG kept for uploads
+        yield f"stored_image/{name}", lambda data: StoredImage("benchmark", data), lambda: png
+
+        for font_file in fonts:
+            font = load_font(os.path.join(FONTS_DIR, font_file), font_size_for(size))
+            yield f"wrap_text/{name}/{font_file}", lambda _, f=font, width=size[0]: wrap_text(TEXT, width, f), None
+            for outline_width in OUTLINE_WIDTHS:
+                suffix = f"{name}/{font_file}/outline{outline_width}"
+                canvas = Image.new("RGB", (size[0], font_size_for(size) * 2), (90, 90, 200))
+                yield (f"draw_text_with_outline/{suffix}",
+                       lambda image, f=font, w=outline_width: draw_text_with_outline(
+                           ImageDraw.Draw(image), (w, w), "HEADLINE TEXT", f, "#FFFFFF", "#000000", w),
+                       canvas.copy)
+                yield (f"add_text_to_image/{suffix}",
+                       lambda image, f=font, w=outline_width, font_size=font_size_for(size): add_text_to_image(
+                           image, 0, TEXT, f, font_size, 1.0, "#FFFFFF", "#000000", w),
+                       base.copy)
+
+def machine():
+    return {"python": platform.python_version(), "pillow": PIL.__version__, "numpy": np.__version__,
+            "platform": platform.platform(), "processor": platform.processor() or platform.machine(), "cpus": os.cpu_count()}
+
+def save_results(path, results):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"machine": machine(), "results": results}, f, indent=1, sort_keys=True)
+    print(f"Saved {len(results)} results to {path}")
+
+def compare_results(path, results, threshold):
+    # Prints the cases slower than the baseline by more than threshold and returns how many there were
+    with open(path) as f:
+        baseline = json.load(f)["results"]
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        if ratio > threshold:
+            regressions += 1
+            print(f"REGRESSION {name}: {baseline[name]['median'] * 1000:.2f} ms -> {result['median'] * 1000:.2f} ms ({ratio:.2f}x)")
+    print(f"{regressions} of {len(results)} cases slower than {threshold:.2f}x the baseline in {path}")
+    return regressions
+
+def add_arguments(parser):
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio reported as a regression")
+
+def report(args, results):
+    if args.save:
+        save_results(args.save, results)
+    if args.compare and compare_results(args.compare, results, args.threshold):
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the image processing hot paths")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME, help="seconds to spend timing each case")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    results = {}
+    for name, func, setup in cases():
+        if args.filter not in name:
+            continue
+        results[name] = measure(func, setup, args.min_time)
+        print(f"{name:<72} {results[name]['median'] * 1000:10.3f} ms  (x{results[name]['repeats']})")
+    report(args, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# Compare the offset-loop outline against Pillow's native stroke for every bundled font
+# Run from the repository root: python benchmarks/text_outline.py
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, APP_DIR)
+from imaging import draw_text_with_outline
+
+FONTS_DIR = os.path.join(APP_DIR, "fonts")
+OUTLINE_WIDTHS = [2, 8, 16]
+TEXT = "THIS IS SOME REALLY LONG TEXT"
+
+def legacy_draw_text_with_outline(_draw, position, text, _font, text_color, outline_color, outline_width):
+    # The original implementation from pages/Add_Text.py, kept for comparison
+    x, y = position
+    for dx in range(-outline_width, outline_width+1):
+        for dy in range(-outline_width, outline_width+1):
+            if dx == 0 and dy == 0:
+                continue
+            _draw.text((x + dx, y + dy), text, font=_font, fill=outline_color)
+    _draw.text((x, y), text, font=_font, fill=text_color)
+
+def render(func, font, outline_width):
+    image = Image.new("RGB", (1792, 300), (90, 90, 200))
+    start = time.perf_counter()
+    func(ImageDraw.Draw(image), (40, 80), TEXT, font, "#FFFFFF", "#000000", outline_width)
+    return np.asarray(image, dtype=np.int16), time.perf_counter() - start
+
+def main():
+    print(f"{'font':<24} {'width':>5} {'legacy ms':>10} {'stroke ms':>10} {'mean diff':>10} {'% px > 64':>10}")
+    for font_file in sorted(os.listdir(FONTS_DIR)):
+        font = ImageFont.truetype(os.path.join(FONTS_DIR, font_file), 120)
+        for outline_width in OUTLINE_WIDTHS:
+            legacy, legacy_time = render(legacy_draw_text_with_outline, font, outline_width)
+            stroked, stroke_time = render(draw_text_with_outline, font, outline_width)
+            diff = np.abs(legacy - stroked).max(axis=2)
+            print(f"{font_file:<24} {outline_width:>5} {legacy_time * 1000:>10.1f} {stroke_time * 1000:>10.1f} "
+                  f"{diff.mean():>10.2f} {(diff > 64).mean() * 100:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+import batch
+import generation
+import imaging
+from batch import BatchPipeline
+from result_cache import ResultCache
+from scheduler import RequestScheduler
+
+class FinishedJob:
+    key = "generated_images/ab/abc.png"
+    status = "done"
+
+    def wait(self, timeout=None):
+        return True
+
+def test_partial_generation_fails_the_stage(tmp_path, monkeypatch):
+    # One of two requests failed, so the item must not be recorded as generated or a resume would never retry it
+    monkeypatch.setattr(batch, "generate_images_from_prompt", lambda *args, **kwargs: ["cache://one"])
+    pipeline = BatchPipeline(None, str(tmp_path), number=2, refine=False, upload=False)
+    record = pipeline.process({"id": "item", "headline": "A headline", "text": "A headline", "subheading": None})
+    assert record["stage"] == "failed"
+    assert "1 of 2" in record["error"]
+    assert "raw_files" not in record
+    with open(tmp_path / "manifest.jsonl") as f:
+        assert [json.loads(line)["stage"] for line in f] == ["refined", "failed"]
+
+def test_uploads_record_the_rendered_size(tmp_path, monkeypatch):
+    uploads = []
+    monkeypatch.setattr(batch, "queue_upload", lambda data, metadata=None: uploads.append(metadata) or FinishedJob())
+    raw_file = os.path.join(tmp_path, "raw", "item-0.png")
+    os.makedirs(os.path.dirname(raw_file))
+    Image.new("RGB", (1024, 1024), (40, 90, 160)).save(raw_file)
+
+    pipeline = BatchPipeline(None, str(tmp_path), shape="1024x1024", sizes=[(1200, 630), (640, 360)])
+    record = {"id": "item", "prompt": "A prompt", "text": "A headline", "subheading": None}
+    record["outputs"] = pipeline.render(record, raw_file)
+    pipeline.upload_outputs(record)
+    assert [metadata["size"] for metadata in uploads] == ["1200x630", "640x360"]
+
+def render_variant(tmp_path, design, size=(1200, 630)):
+    raw_file = os.path.join(tmp_path, "raw", "item-0.png")
+    os.makedirs(os.path.dirname(raw_file), exist_ok=True)
+    Image.new("RGB", (1024, 1024), (200, 200, 200)).save(raw_file)
+    pipeline = BatchPipeline(None, str(tmp_path), upload=False, sizes=[size], design=design)
+    output, = pipeline.render({"id": "item", "text": "A headline", "subheading": None}, raw_file)
+    return Image.open(output).convert("RGB")
+
+def test_sizes_apply_the_design_style_and_pixel_offset(tmp_path):
+    # Yellow text, and a Left gradient 512px into the 1024px wide image, so half of every output's width
+    image = render_variant(tmp_path, {"text_color": "#FFFF00", "gradient": "Left", "gradient_offset": 512})
+    colors = {color for _, color in image.getcolors(1 << 20)}
+    assert any(r > 200 and g > 200 and b < 60 for r, g, b in colors)
+    row = [image.getpixel((x, 5)) for x in range(image.width)]
+    darkened = sum(pixel != (200, 200, 200) for pixel in row)
+    assert abs(darkened - image.width // 2) <= 2
+
+def test_sizes_refuse_design_keys_that_are_fitted(tmp_path):
+    with pytest.raises(ValueError, match="font_size"):
+        BatchPipeline(None, str(tmp_path), upload=False, sizes=[(640, 360)], design={"font_size": 80})
+
+def test_sizes_let_the_design_set_max_lines(tmp_path, monkeypatch):
+    layouts = []
+    def render_layout_sizes(image, layout, sizes):
+        layouts.append(layout)
+        return imaging.render_layout_sizes(image, layout, sizes)
+    monkeypatch.setattr(batch, "render_layout_sizes", render_layout_sizes)
+    raw_file = os.path.join(tmp_path, "raw", "item-0.png")
+    os.makedirs(os.path.dirname(raw_file))
+    Image.new("RGB", (1024, 1024), (200, 200, 200)).save(raw_file)
+    pipeline = BatchPipeline(None, str(tmp_path), upload=False, sizes=[(640, 360)], design={"max_lines": 1})
+    output, = pipeline.render({"id": "item", "text": "A headline long enough to wrap", "subheading": "And a subheading"}, raw_file)
+    assert [box["max_lines"] for box in layouts[0]["boxes"]] == [1, 1]
+    assert [len(imaging.place_text_box(box, (640, 360))["lines"]) for box in layouts[0]["boxes"]] == [1, 1]
+    assert Image.open(output).size == (640, 360)
+
+def test_failed_refinement_fails_the_item_and_is_retried(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(generation, "get_result_cache", lambda: cache)
+    monkeypatch.setattr(generation, "get_scheduler", lambda: RequestScheduler())
+    monkeypatch.setattr(batch, "generate_images_from_prompt", lambda *args, **kwargs: pytest.fail("generated from an unrefined headline"))
+    def broken(**kwargs):
+        raise ConnectionError("connection reset")
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=broken)))
+    item = {"id": "item", "headline": "A headline", "text": "A headline", "subheading": None}
+    record = BatchPipeline(client, str(tmp_path), upload=False).process(item)
+    assert record["stage"] == "failed"
+    assert "connection reset" in record["error"]
+    assert "prompt" not in BatchPipeline(client, str(tmp_path), upload=False).manifest.state["item"]
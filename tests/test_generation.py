@@ -0,0 +1,84 @@
+import threading
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+import generation
+import storage
+from generation import generate_image, generate_images_from_prompt
+from result_cache import CACHE_URL_PREFIX, ResultCache
+from scheduler import RequestScheduler
+from storage import ImageStore
+
+def png_bytes(n):
+    buffer = BytesIO()
+    Image.new("RGB", (64, 64), (n * 80 % 256, 120, 200)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+class StubImages:
+    # images.generate returns a fresh URL each call, serving a different picture for each
+    def __init__(self):
+        self.served = {}
+
+    def generate(self, **kwargs):
+        url = f"https://example.com/{len(self.served)}.png"
+        self.served[url] = png_bytes(len(self.served))
+        return SimpleNamespace(data=[SimpleNamespace(url=url)])
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(generation, "get_result_cache", lambda: cache)
+    monkeypatch.setattr(storage, "get_result_cache", lambda: cache)
+    monkeypatch.setattr(generation, "get_scheduler", lambda: RequestScheduler(limits={"dall-e-3": (6000, 10)}))
+    return SimpleNamespace(images=StubImages(), cache=cache)
+
+def test_cached_image_is_reused(client):
+    store = ImageStore(fetch=client.images.served.__getitem__)
+    first, _ = generate_image(client, "a cat", "dall-e-3", "1024x1024", _store=store, upload=False)
+    again, _ = generate_image(client, "a cat", "dall-e-3", "1024x1024", _store=store, upload=False)
+    assert again.startswith(CACHE_URL_PREFIX)
+    assert len(client.images.served) == 1
+    assert client.cache.get("image", again[len(CACHE_URL_PREFIX):]) == client.images.served[first]
+
+def test_forced_regeneration_keeps_the_earlier_image(client):
+    store = ImageStore(fetch=client.images.served.__getitem__)
+    generate_image(client, "a cat", "dall-e-3", "1024x1024", _store=store, upload=False)
+    earlier, _ = generate_image(client, "a cat", "dall-e-3", "1024x1024", _store=store, upload=False)
+    generate_image(client, "a cat", "dall-e-3", "1024x1024", _store=store, upload=False, force=True)
+    latest, _ = generate_image(client, "a cat", "dall-e-3", "1024x1024", _store=store, upload=False)
+
+    # The grid's earlier cache:// URL still resolves to the first picture, even from a new session's store
+    assert latest != earlier
+    fresh_store = ImageStore()
+    assert fresh_store.get(earlier).png == client.images.served["https://example.com/0.png"]
+    assert fresh_store.get(latest).png == client.images.served["https://example.com/1.png"]
+
+class FlakyImages(StubImages):
+    # The second request fails, whichever worker thread sends it
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def generate(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+            if self.calls == 2:
+                raise RuntimeError("content policy violation")
+            return super().generate(**kwargs)
+
+def test_a_failed_request_keeps_the_other_images(client):
+    client.images = FlakyImages()
+    store = ImageStore(fetch=client.images.served.__getitem__)
+    images, errors = [], []
+    urls = generate_images_from_prompt(client, "a cat", number=4, model="dall-e-3", shape="1024x1024", _store=store, upload=False,
+                                       on_image=lambda index, url, upload_job: images.append((index, url)),
+                                       on_error=lambda message, error=None: errors.append(error))
+    assert sorted(urls) == sorted(client.images.served)
+    assert len(urls) == 3
+    assert [index for index, _ in images] == [0, 1, 2]
+    assert sorted(url for _, url in images) == sorted(urls)
+    assert [str(error) for error in errors] == ["content policy violation"]
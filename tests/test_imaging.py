@@ -0,0 +1,80 @@
+import json
+import os
+import subprocess
+import sys
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from imaging import MAX_EDIT_SIZE, load_image, variation_png
+from tracing import resident_memory
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+def photo(size, seed=0):
+    # Smooth colour fields with fine grain, so the files compress roughly like a photo
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray(rng.integers(0, 256, (max(1, size[1] // 64), max(1, size[0] // 64), 3), dtype=np.uint8))
+    smooth = np.asarray(coarse.resize(size, Image.BICUBIC), dtype=np.int16)
+    return Image.fromarray(np.clip(smooth + rng.integers(-6, 7, smooth.shape, dtype=np.int16), 0, 255).astype(np.uint8))
+
+def encoded(image, file_format):
+    buffer = BytesIO()
+    image.save(buffer, file_format, **({"quality": 90} if file_format == "JPEG" else {"compress_level": 1}))
+    return buffer.getvalue()
+
+@pytest.mark.parametrize("file_format", ["JPEG", "PNG"])
+@pytest.mark.parametrize("decode", [load_image, lambda file: load_image(file, 100), variation_png])
+def test_truncated_uploads_raise_value_error(file_format, decode):
+    data = encoded(photo((400, 300)), file_format)
+    with pytest.raises(ValueError, match="Not a usable image"):
+        decode(BytesIO(data[:len(data) // 2]))
+
+def test_load_image_resamples_large_jpegs_to_the_cap():
+    image = load_image(BytesIO(encoded(photo((6000, 4000)), "JPEG")), MAX_EDIT_SIZE)
+    assert image.size == (MAX_EDIT_SIZE, 2731)
+
+def test_load_image_keeps_full_resolution_under_the_cap():
+    image = load_image(BytesIO(encoded(photo((3000, 2000)), "JPEG")), MAX_EDIT_SIZE)
+    assert image.size == (3000, 2000)
+
+# Runs in a fresh interpreter, so earlier cases do not hide its peak: decodes the file as the named
+# page does and prints the span's peak memory
+CASE = """
+import json, sys
+from io import BytesIO
+from imaging import load_image, variation_png
+from tracing import span
+
+pipelines = {"variation": variation_png, "editor": lambda file: load_image(file, 800)}  # The editor's 800 pixel preview
+with open(sys.argv[2], "rb") as f:
+    upload = BytesIO(f.read())  # Streamlit hands pages the whole upload in memory too
+with span("case", track_memory=True) as s:
+    pipelines[sys.argv[1]](upload)
+print(json.dumps(s.attrs["peak_memory"]))
+"""
+
+# Peak memory limits in MB for a 24 megapixel upload. One full size decode alone is 96 MB; JPEGs are
+# decoded reduced, PNGs cannot be. Before uploads were decoded reduced these were 194 to 234 MB.
+PEAK_LIMITS = {("JPEG", "variation"): 64, ("JPEG", "editor"): 32, ("PNG", "variation"): 136, ("PNG", "editor"): 136}
+
+@pytest.fixture(scope="module")
+def uploads(tmp_path_factory):
+    image = photo((6000, 4000))
+    paths = {}
+    for file_format in ["JPEG", "PNG"]:
+        paths[file_format] = tmp_path_factory.mktemp("uploads") / f"upload.{file_format.lower()}"
+        paths[file_format].write_bytes(encoded(image, file_format))
+    return paths
+
+@pytest.mark.skipif(resident_memory() is None, reason="peak memory is read from /proc")
+@pytest.mark.parametrize("file_format, pipeline", list(PEAK_LIMITS))
+def test_upload_decoding_peak_memory(uploads, file_format, pipeline):
+    process = subprocess.run([sys.executable, "-c", CASE, pipeline, str(uploads[file_format])], capture_output=True, text=True,
+                             env={**os.environ, "PYTHONPATH": APP_DIR}, check=True)
+    peak = json.loads(process.stdout)
+    if peak is None:
+        pytest.skip("the peak memory mark could not be reset")
+    assert peak / 1e6 <= PEAK_LIMITS[file_format, pipeline]
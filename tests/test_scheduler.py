@@ -0,0 +1,154 @@
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+from scheduler import BATCH, RequestScheduler, batch_limits
+
+class FakeClock:
+    # Sleeping advances time instantly, for single threaded tests
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class ManualClock:
+    # Sleepers block until the test advances time past their wake up
+    def __init__(self):
+        self.now = 0.0
+        self.condition = threading.Condition()
+
+    def time(self):
+        with self.condition:
+            return self.now
+
+    def sleep(self, seconds):
+        with self.condition:
+            wake = self.now + seconds
+            while self.now < wake:
+                self.condition.wait()
+
+    def advance(self, seconds):
+        with self.condition:
+            self.now += seconds
+            self.condition.notify_all()
+
+def rate_limit_error(headers=None):
+    request = httpx.Request("POST", "https://api.openai.com/v1/images/generations")
+    response = httpx.Response(429, headers=headers or {}, request=request)
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+class StubAPI:
+    # Answers 429 for the first `limited` calls, then succeeds, recording when each call arrived
+    def __init__(self, clock, limited=0, headers=None):
+        self.clock = clock
+        self.limited = limited
+        self.headers = headers
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append((self.clock.time(), kwargs))
+        if len(self.calls) <= self.limited:
+            raise rate_limit_error(self.headers)
+        return kwargs
+
+def test_bucket_spaces_calls_after_the_burst():
+    clock = FakeClock()
+    scheduler = RequestScheduler(limits={"dall-e-3": (60, 2)}, clock=clock)
+    api = StubAPI(clock)
+    for _ in range(5):
+        scheduler.call("dall-e-3", api)
+    assert [when for when, _ in api.calls] == pytest.approx([0, 0, 1, 2, 3])
+
+def test_retry_after_is_honoured():
+    clock = FakeClock()
+    scheduler = RequestScheduler(limits={"dall-e-3": (6000, 10)}, clock=clock)
+    api = StubAPI(clock, limited=1, headers={"retry-after": "7"})
+    assert scheduler.call("dall-e-3", api, prompt="a cat") == {"prompt": "a cat"}
+    assert len(api.calls) == 2
+    assert api.calls[1][0] == pytest.approx(7)
+
+def test_retry_after_ms_pauses_every_caller_of_the_model():
+    clock = FakeClock()
+    scheduler = RequestScheduler(limits={"dall-e-2": (6000, 10)}, clock=clock)
+    scheduler.call("dall-e-2", StubAPI(clock, limited=1, headers={"retry-after-ms": "2500"}))
+    paused_at = clock.now
+    other = StubAPI(clock)
+    scheduler.call("dall-e-2", other)
+    assert paused_at == pytest.approx(2.5)
+    assert other.calls[0][0] >= paused_at
+
+def test_rate_limits_are_raised_once_retries_run_out():
+    clock = FakeClock()
+    scheduler = RequestScheduler(limits={"dall-e-3": (6000, 10)}, clock=clock, max_retries=2, backoff=1.0)
+    api = StubAPI(clock, limited=10)
+    with pytest.raises(openai.RateLimitError):
+        scheduler.call("dall-e-3", api)
+    assert len(api.calls) == 3
+
+def test_other_errors_are_not_retried():
+    clock = FakeClock()
+    scheduler = RequestScheduler(clock=clock)
+    calls = []
+    def broken(**kwargs):
+        calls.append(kwargs)
+        raise ValueError("bad request")
+    with pytest.raises(ValueError):
+        scheduler.call("dall-e-3", broken)
+    assert len(calls) == 1
+
+def test_model_keyword_is_forwarded():
+    clock = FakeClock()
+    scheduler = RequestScheduler(clock=clock)
+    api = StubAPI(clock)
+    scheduler.call("dall-e-3", api, model="dall-e-3", prompt="a cat", n=1)
+    assert api.calls[0][1] == {"model": "dall-e-3", "prompt": "a cat", "n": 1}
+
+def test_interactive_call_jumps_queued_batch_calls():
+    clock = ManualClock()
+    scheduler = RequestScheduler(limits={"dall-e-3": (60, 1)}, clock=clock)
+    order = []
+    scheduler.call("dall-e-3", order.append, "first")  # Takes the only token
+
+    def queue_call(label, priority):
+        thread = threading.Thread(target=scheduler.call, args=("dall-e-3", order.append, label), kwargs={"priority": priority})
+        thread.start()
+        return thread
+
+    def wait_for_queue(length):
+        deadline = time.monotonic() + 5
+        while len(scheduler.queues["dall-e-3"]) < length:
+            assert time.monotonic() < deadline, "calls did not queue"
+            time.sleep(0.01)
+
+    threads = []
+    for n in range(3):
+        threads.append(queue_call(f"batch-{n}", BATCH))
+        wait_for_queue(n + 1)
+    threads.append(queue_call("interactive", 0))
+    wait_for_queue(4)
+
+    deadline = time.monotonic() + 30
+    while any(thread.is_alive() for thread in threads):
+        assert time.monotonic() < deadline, f"calls did not finish, ran {order}"
+        clock.advance(1)
+        time.sleep(0.05)
+    assert order == ["first", "interactive", "batch-0", "batch-1", "batch-2"]
+
+def test_batch_limits_leave_part_of_the_tier_to_the_app():
+    limits = batch_limits(0.5)
+    assert limits["dall-e-3"] == (7.5, 1)
+    clock = FakeClock()
+    scheduler = RequestScheduler(limits=limits, clock=clock)
+    api = StubAPI(clock)
+    for _ in range(3):
+        scheduler.call("dall-e-3", api)
+    assert [when for when, _ in api.calls] == pytest.approx([0, 8, 16])
@@ -0,0 +1,96 @@
+from io import BytesIO
+
+import boto3
+import numpy as np
+import pytest
+from moto import mock_aws
+from PIL import Image
+
+from storage import ImageIndex, ImageStore, UploadQueue
+
+BUCKET = "uploads"
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="test", aws_secret_access_key="test")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+def flaky(client, failures):
+    # Client factory that raises on its first few calls, as a dropped connection to R2 would
+    calls = []
+    def factory():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise ConnectionError("connection reset")
+        return client
+    return factory
+
+def test_upload_retries_then_succeeds(s3, tmp_path):
+    sleeps = []
+    uploads = UploadQueue(client_factory=flaky(s3, 2), bucket=BUCKET, sleep=sleeps.append, index=ImageIndex(str(tmp_path / "index.sqlite3")))
+    job = uploads.submit(b"image bytes")
+    assert job.wait(10)
+    assert job.status == "done"
+    assert job.attempts == 3
+    # Backoff of 0.5s doubling per attempt, with +/-50% jitter
+    assert len(sleeps) == 2 and 0.25 <= sleeps[0] <= 0.75 and 0.5 <= sleeps[1] <= 1.5
+    assert job.data is None
+    assert s3.get_object(Bucket=BUCKET, Key=job.key)["Body"].read() == b"image bytes"
+
+def test_upload_fails_after_retries(s3):
+    uploads = UploadQueue(client_factory=lambda: s3, bucket="missing-bucket", retries=2, sleep=lambda seconds: None)
+    job = uploads.submit(b"image bytes")
+    assert job.wait(10)
+    assert job.status == "failed"
+    assert job.attempts == 3
+    assert "NoSuchBucket" in job.error
+
+def test_duplicate_upload_is_skipped(s3, tmp_path):
+    index = ImageIndex(str(tmp_path / "index.sqlite3"))
+    uploads = UploadQueue(client_factory=lambda: s3, bucket=BUCKET, sleep=lambda seconds: None, index=index)
+    first = uploads.submit(b"image bytes", metadata={"prompt": "a cat"})
+    assert first.wait(10) and first.status == "done"
+    assert index.lookup(first.digest)["prompt"] == "a cat"
+
+    second = uploads.submit(b"image bytes")
+    assert second.status == "duplicate"
+    assert second.key == first.key
+    assert len(s3.list_objects_v2(Bucket=BUCKET)["Contents"]) == 1
+
+def test_identical_uploads_in_flight_share_a_job(s3):
+    uploads = UploadQueue(client_factory=lambda: s3, bucket=BUCKET, workers=0, sleep=lambda seconds: None)
+    first = uploads.submit(b"image bytes")
+    assert uploads.submit(b"image bytes") is first
+    assert uploads.submit(b"other bytes") is not first
+
+def png_of_size(size, seed):
+    buffer = BytesIO()
+    Image.fromarray(np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)).save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+def test_thumbnails_outlive_evicted_pngs():
+    # 15 images where the budget holds about a third of their PNGs: drawing the grid again never fetches
+    images = {f"https://images/{n}.png": png_of_size((256, 256), n) for n in range(15)}
+    fetched = []
+    store = ImageStore(max_bytes=5 * len(images["https://images/0.png"]), fetch=lambda url: fetched.append(url) or images[url])
+    for url in images:
+        store.get(url)
+    assert len(store.entries) < len(images)
+    for _ in range(3):
+        assert all(store.thumbnail(url) is not None for url in images)
+    assert len(fetched) == len(images)
+    assert store.peek("https://images/0.png") is None
+    assert store.get("https://images/0.png").png == images["https://images/0.png"]
+    assert len(fetched) == len(images) + 1
+
+def test_unknown_thumbnails_are_fetched_once():
+    fetched = []
+    def fail(url):
+        fetched.append(url)
+        raise ConnectionError("expired")
+    store = ImageStore(fetch=fail)
+    assert store.thumbnail("https://images/expired.png") is None
+    assert store.thumbnail("https://images/expired.png") is None
+    assert fetched == ["https://images/expired.png"]
@@ -0,0 +1,23 @@
+import tracing
+from tracing import Tracer
+
+def test_peak_memory_is_none_when_the_peak_mark_cannot_be_reset(monkeypatch):
+    # Otherwise the span would report the peak over the whole life of the process
+    monkeypatch.setattr(tracing, "resident_memory", lambda: (100, 1000))
+    monkeypatch.setattr(tracing, "reset_peak_memory", lambda: False)
+    tracer = Tracer()
+    with tracer.span("decode", track_memory=True) as outer:
+        with tracer.span("inner", track_memory=True) as inner:
+            pass
+    assert outer.attrs["peak_memory"] is None
+    assert inner.attrs["peak_memory"] is None
+    assert tracer.summary()["decode"]["peak_memory"] == 0
+
+def test_peak_memory_is_the_rise_above_the_start(monkeypatch):
+    usage = iter([(100, 100), (150, 400)])
+    monkeypatch.setattr(tracing, "resident_memory", lambda: next(usage))
+    monkeypatch.setattr(tracing, "reset_peak_memory", lambda: True)
+    tracer = Tracer()
+    with tracer.span("decode", track_memory=True) as s:
+        pass
+    assert s.attrs["peak_memory"] == 300